@@ -0,0 +1,266 @@
+"""
+ADB 主機協定客戶端
+直接透過 adb server socket (TCP 5037) 溝通，避免每次呼叫都啟動 adb 行程
+"""
+
+import socket
+import threading
+
+ADB_HOST = "127.0.0.1"
+ADB_PORT = 5037
+
+# 持久 shell 的結束標記（指令中以 "" 拆開，避免 PTY 回顯時誤判）
+_END_MARK = b"__SBSS_END__"
+_END_CMD = 'echo __SBSS""_END__ $?'
+
+
+class AdbError(Exception):
+    """adb server 回應 FAIL 或連線中斷"""
+
+
+class AdbCommandSentError(AdbError):
+    """指令已送出但讀取結果失敗（例如逾時），指令可能已執行，不可重送"""
+
+
+def _encode_request(request):
+    """編碼請求：4 位十六進位長度 + 內容"""
+    data = request.encode("utf-8")
+    return b"%04x" % len(data) + data
+
+
+def _recv_exact(sock, size):
+    """讀取剛好 size 位元組"""
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise AdbError("連線已關閉")
+        buf += chunk
+    return bytes(buf)
+
+
+def _recv_all(sock):
+    """讀取到連線結束"""
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _read_status(sock):
+    """讀取 OKAY/FAIL 回應，FAIL 時拋出 AdbError"""
+    status = _recv_exact(sock, 4)
+    if status == b"OKAY":
+        return
+    if status == b"FAIL":
+        length = int(_recv_exact(sock, 4), 16)
+        raise AdbError(_recv_exact(sock, length).decode("utf-8", "replace"))
+    raise AdbError(f"未知回應: {status!r}")
+
+
+class AdbClient:
+    """adb server 協定客戶端（每個服務請求使用一條新的本機連線）"""
+    def __init__(self, host=ADB_HOST, port=ADB_PORT, timeout=10.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def _open(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _request(self, sock, request):
+        sock.sendall(_encode_request(request))
+        _read_status(sock)
+
+    def host_query(self, request):
+        """送出 host:* 請求，返回回應字串"""
+        with self._open() as sock:
+            self._request(sock, request)
+            length = int(_recv_exact(sock, 4), 16)
+            return _recv_exact(sock, length).decode("utf-8", "replace")
+
+    def transport(self, serial):
+        """開啟指定設備的 transport，返回已切換的 socket"""
+        sock = self._open()
+        try:
+            self._request(sock, f"host:transport:{serial}")
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def connect(self, addr):
+        """等同 adb connect，返回 server 訊息"""
+        return self.host_query(f"host:connect:{addr}")
+
+    def devices(self):
+        """等同 adb devices，返回 [(serial, status), ...]"""
+        result = []
+        for line in self.host_query("host:devices").splitlines():
+            if "\t" in line:
+                serial, status = line.split("\t", 1)
+                result.append((serial, status.strip()))
+        return result
+
+    def track_devices(self):
+        """
+        訂閱 host:track-devices，設備狀態變化時產生 [(serial, status), ...]
+        第一次立即產生目前列表；連線中斷時拋出 AdbError/OSError
+        """
+        with self._open() as sock:
+            self._request(sock, "host:track-devices")
+            sock.settimeout(None)  # 長連線，等待下一次變化
+            while True:
+                length = int(_recv_exact(sock, 4), 16)
+                result = []
+                for line in _recv_exact(sock, length).decode("utf-8", "replace").splitlines():
+                    if "\t" in line:
+                        serial, status = line.split("\t", 1)
+                        result.append((serial, status.strip()))
+                yield result
+
+    def exec_out(self, serial, cmd):
+        """等同 adb exec-out，返回原始輸出位元組"""
+        with self.transport(serial) as sock:
+            self._request(sock, f"exec:{cmd}")
+            return _recv_all(sock)
+
+    def shell(self, serial, cmd):
+        """等同 adb shell（單次），返回輸出字串"""
+        with self.transport(serial) as sock:
+            self._request(sock, f"shell:{cmd}")
+            return _recv_all(sock).decode("utf-8", "replace").replace("\r\n", "\n")
+
+    def open_shell(self, serial):
+        """開啟可重複使用的持久 shell"""
+        sock = self.transport(serial)
+        try:
+            self._request(sock, "shell:sh")
+        except Exception:
+            sock.close()
+            raise
+        return ShellSession(sock)
+
+
+class ShellSession:
+    """持久 shell：同一條 transport 連續執行多個指令"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.closed = False
+        self._buf = b""
+
+    def run(self, cmd):
+        """
+        執行指令，返回 (returncode, 輸出字串)
+        送出失敗拋出 OSError/AdbError（指令未執行，可重試）；送出後讀取失敗拋出 AdbCommandSentError
+        """
+        with self.lock:
+            if self.closed:
+                raise AdbError("shell 已關閉")
+            try:
+                self.sock.sendall(f"{cmd}\n{_END_CMD}\n".encode("utf-8"))
+            except OSError:
+                self.close()
+                raise
+            try:
+                return self._read_until_mark()
+            except (OSError, AdbError) as e:
+                self.close()
+                raise AdbCommandSentError(f"讀取結果失敗: {e}") from e
+
+    def _read_until_mark(self):
+        while True:
+            idx = self._buf.find(_END_MARK)
+            if idx >= 0:
+                end = self._buf.find(b"\n", idx)
+                if end >= 0:
+                    output = self._buf[:idx]
+                    code = self._buf[idx + len(_END_MARK):end].strip()
+                    self._buf = self._buf[end + 1:]
+                    try:
+                        returncode = int(code)
+                    except ValueError:
+                        returncode = -1
+                    return returncode, output.decode("utf-8", "replace").replace("\r\n", "\n")
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise AdbError("shell 連線已關閉")
+            self._buf += chunk
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class AdbConnectionPool:
+    """
+    每個設備保留一條持久 shell，斷線時自動重建
+    建立連線只鎖該設備，無回應的設備不會卡住其他設備
+    """
+    def __init__(self, client=None):
+        self.client = client or AdbClient()
+        self._sessions = {}
+        self._serial_locks = {}
+        self._lock = threading.Lock()
+
+    def _serial_lock(self, serial):
+        with self._lock:
+            lock = self._serial_locks.get(serial)
+            if lock is None:
+                lock = self._serial_locks[serial] = threading.Lock()
+            return lock
+
+    def _session(self, serial):
+        """取得設備的 shell，返回 (session, 是否為既有連線)"""
+        with self._serial_lock(serial):
+            session = self._sessions.get(serial)
+            if session is not None and not session.closed:
+                return session, True
+            session = self.client.open_shell(serial)
+            self._sessions[serial] = session
+            return session, False
+
+    def shell(self, serial, cmd):
+        """
+        在設備的持久 shell 執行指令，返回 (returncode, 輸出字串)
+        只有送出失敗才重試；已送出的指令（AdbCommandSentError）不重送，避免點擊重複執行
+        """
+        session, reused = self._session(serial)
+        try:
+            return session.run(cmd)
+        except AdbCommandSentError:
+            raise
+        except (OSError, AdbError):
+            if not reused:
+                raise
+        # 既有連線可能已失效（設備重啟等），重建一次
+        session, _ = self._session(serial)
+        return session.run(cmd)
+
+    def exec_out(self, serial, cmd):
+        """二進位輸出（如截圖）走獨立的 exec 連線"""
+        return self.client.exec_out(serial, cmd)
+
+    def close(self, serial=None):
+        """關閉連線（不指定設備時全部關閉）"""
+        with self._lock:
+            serials = [serial] if serial else list(self._sessions)
+        for s in serials:
+            with self._serial_lock(s):
+                session = self._sessions.pop(s, None)
+            if session:
+                session.close()
+
+
+# 全局連線池
+client = AdbClient()
+pool = AdbConnectionPool(client)
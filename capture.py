@@ -0,0 +1,395 @@
+"""
+畫面來源：單次截圖 / 持續串流 / 點擊後變化等待
+"""
+
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+import core
+
+
+def find_ffmpeg():
+    """取得 ffmpeg 路徑（優先內嵌，其次系統 PATH），找不到返回 None"""
+    exe = "ffmpeg.exe" if sys.platform == "win32" else "ffmpeg"
+    bundled = core.get_base_dir() / "ffmpeg" / exe
+    if bundled.exists():
+        return str(bundled)
+    return shutil.which("ffmpeg")
+
+
+class ScreenshotSource:
+    """單次截圖：每次 grab 都做一次 screencap"""
+    executor = None  # 點擊直接在比對線程執行
+
+    def __init__(self, device, capture_mode="raw"):
+        self.device = device
+        self.capture_mode = capture_mode
+
+    def grab(self):
+        """取得目前畫面，失敗返回 None"""
+        return core.adb_screenshot(device=self.device, mode=self.capture_mode)
+
+    def wait(self, timeout):
+        """等待下一次截圖時機"""
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+class StreamFrameSource:
+    """
+    持續串流：adb exec-out screenrecord (H.264) → ffmpeg 解碼 → 背景線程保留最新一幀
+    - 畫面沒變化時 screenrecord 不會送新幀，最新一幀仍然有效
+    - screenrecord 有時間上限，結束後自動重啟
+    - 串流無法啟動時 grab 改用單次截圖
+    """
+    MIN_FRAME_INTERVAL = 0.05  # 畫面持續變化時，兩次比對的最短間隔（秒）
+    MAX_FAILURES = 3
+    executor = None
+
+    def __init__(self, device, width, height, capture_mode="raw", bit_rate=8000000):
+        self.device = device
+        self.width = width
+        self.height = height
+        self.bit_rate = bit_rate
+        self.fallback = ScreenshotSource(device, capture_mode)
+        self.failed = False
+        self._frame = None
+        self._seq = 0
+        self._grabbed_seq = 0
+        self._last_grab = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._procs = []
+        self._thread = None
+
+    def start(self):
+        """啟動串流，找不到 ffmpeg 返回 False"""
+        ffmpeg = find_ffmpeg()
+        if not ffmpeg:
+            core.adb_log("StreamFrameSource: 找不到 ffmpeg，改用單次截圖")
+            self.failed = True
+            return False
+        self._thread = threading.Thread(target=self._run, args=(ffmpeg,), daemon=True)
+        self._thread.start()
+        return True
+
+    def _spawn(self, ffmpeg):
+        adb = subprocess.Popen(
+            [core.ADB_PATH, "-s", self.device, "exec-out", "screenrecord",
+             "--output-format=h264", "--size", f"{self.width}x{self.height}",
+             "--bit-rate", str(self.bit_rate), "-"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        decoder = subprocess.Popen(
+            [ffmpeg, "-loglevel", "error", "-fflags", "nobuffer", "-flags", "low_delay",
+             "-probesize", "32", "-f", "h264", "-i", "pipe:0",
+             "-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1"],
+            stdin=adb.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        adb.stdout.close()  # 由 ffmpeg 持有
+        return adb, decoder
+
+    def _read_frames(self, decoder):
+        """讀取解碼後的幀直到串流結束"""
+        frame_size = self.width * self.height * 3
+        while not self._stop.is_set():
+            buf = bytearray(frame_size)
+            view = memoryview(buf)
+            n = 0
+            while n < frame_size:
+                read = decoder.stdout.readinto(view[n:])
+                if not read:
+                    return
+                n += read
+            frame = np.frombuffer(buf, dtype=np.uint8).reshape(self.height, self.width, 3)
+            with self._cond:
+                self._frame = frame
+                self._seq += 1
+                self._cond.notify_all()
+
+    def _run(self, ffmpeg):
+        failures = 0
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self._procs = list(self._spawn(ffmpeg))
+                self._read_frames(self._procs[1])
+            except OSError as e:
+                core.adb_log(f"StreamFrameSource({self.device}): {e}")
+            finally:
+                self._kill()
+
+            if self._stop.is_set():
+                break
+            # 很快就結束代表無法串流（不支援 screenrecord 等）
+            if time.monotonic() - started < 2:
+                failures += 1
+                if failures >= self.MAX_FAILURES:
+                    core.adb_log(f"StreamFrameSource({self.device}): 串流失敗，改用單次截圖")
+                    self.failed = True
+                    with self._cond:
+                        self._cond.notify_all()
+                    break
+                time.sleep(1)
+            else:
+                failures = 0
+
+    def _kill(self):
+        for proc in self._procs:
+            try:
+                proc.kill()
+                proc.wait(timeout=2)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self._procs = []
+
+    def grab(self):
+        """取得最新一幀（尚無幀或串流失敗時改用單次截圖）"""
+        with self._cond:
+            frame = self._frame
+            seq = self._seq
+        if frame is None or self.failed:
+            return self.fallback.grab()
+        self._grabbed_seq = seq
+        self._last_grab = time.monotonic()
+        return frame
+
+    def wait(self, timeout):
+        """等待新幀（最多 timeout 秒），畫面持續變化時也保留最短間隔"""
+        if self.failed:
+            time.sleep(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        earliest = self._last_grab + self.MIN_FRAME_INTERVAL
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._seq != self._grabbed_seq or self.failed or self._stop.is_set(),
+                timeout
+            )
+        remaining = min(earliest, deadline) - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def close(self):
+        self._stop.set()
+        self._kill()
+        with self._cond:
+            self._cond.notify_all()
+
+
+def open_frame_source(device, settings, pipeline=False):
+    """
+    依設定建立畫面來源
+    capture_source: screenshot 單次截圖, stream 持續串流（需要 ffmpeg）
+    pipeline: 單次截圖改由 FramePrefetcher 預取；只有點擊都交給 source.executor 的呼叫端可開啟
+              （直接點擊時預取線程不知道點擊時間，會拿到點擊前的畫面）
+    """
+    capture_mode = settings.get("capture_mode", "raw")
+    source = ScreenshotSource(device, capture_mode)
+    if settings.get("capture_source") != "stream":
+        if pipeline:
+            return FramePrefetcher(source, ActionExecutor(), settings["loop_interval"])
+        return source
+
+    # 先截一張取得串流尺寸
+    first_frame = source.grab()
+    if first_frame is None:
+        return source
+    height, width = first_frame.shape[:2]
+    stream = StreamFrameSource(device, width, height, capture_mode)
+    if stream.start():
+        return stream
+    return source
+
+
+# ============ 管線化 ============
+
+class ActionExecutor:
+    """動作執行器：點擊與擬人延遲在背景線程執行，不阻塞下一次擷取與比對"""
+    def __init__(self):
+        self.last_submit = 0  # 最後一次送出動作的時間 (monotonic)
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, delay=0, **kwargs):
+        """排入動作，執行後再等待 delay 秒"""
+        with self._lock:
+            self._pending += 1
+            self._idle.clear()
+            self.last_submit = time.monotonic()
+        self._queue.put((fn, args, kwargs, delay))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            fn, args, kwargs, delay = item
+            try:
+                if not self._stop.is_set():
+                    fn(*args, **kwargs)
+                    self._stop.wait(delay)
+            except Exception as e:
+                core.adb_log(f"ActionExecutor: {e}")
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                    if self._pending == 0:
+                        self._idle.set()
+
+    def wait_idle(self, timeout=None):
+        """等待所有動作（含延遲）完成"""
+        return self._idle.wait(timeout)
+
+    def close(self):
+        self._stop.set()
+        self._queue.put(None)
+
+
+class FramePrefetcher:
+    """
+    雙緩衝預取：比對目前畫面時，背景線程已在擷取下一幀
+    - 擷取提前「平均擷取耗時」開始，讓畫面在下次比對時剛好就緒
+    - 等點擊與延遲完成才擷取；點擊前開始擷取的幀會被丟棄重拍，比對結果與循序執行相同
+    """
+    def __init__(self, source, executor, interval):
+        self.source = source
+        self.executor = executor
+        self.interval = interval
+        self._est = 0.1  # 擷取耗時估計（指數平均）
+        self._due = None  # 下一幀應該就緒的時間
+        self._result = None  # (frame, 開始擷取時間, due)
+        self._last_grab = time.monotonic()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _schedule(self, due):
+        with self._cond:
+            self._due = due
+            self._result = None
+            self._cond.notify_all()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._cond:
+                self._cond.wait_for(lambda: self._due is not None or self._stop.is_set())
+                if self._stop.is_set():
+                    break
+                due = self._due
+                start_at = due - self._est
+                now = time.monotonic()
+                if now < start_at:
+                    # 提前排程可能被 wait() 改期，醒來後重新檢查
+                    self._cond.wait(start_at - now)
+                    continue
+                self._due = None
+
+            self.executor.wait_idle()
+            started = time.monotonic()
+            frame = self.source.grab()
+            self._est = self._est * 0.8 + (time.monotonic() - started) * 0.2
+
+            with self._cond:
+                if self._due is None:
+                    self._result = (frame, started, due)
+                self._cond.notify_all()
+
+    def grab(self):
+        """取得下一幀（點擊之後才開始擷取的畫面）"""
+        with self._cond:
+            if self._due is None and self._result is None:
+                self._due = time.monotonic()
+                self._cond.notify_all()
+            while not self._stop.is_set():
+                result = self._result
+                if result is not None:
+                    frame, started, _ = result
+                    if started >= self.executor.last_submit:
+                        break
+                    # 點擊前擷取的畫面，重新擷取
+                    self._result = None
+                    self._due = time.monotonic()
+                    self._cond.notify_all()
+                self._cond.wait(0.5)
+            else:
+                return None
+            self._result = None
+            self._last_grab = time.monotonic()
+            # 預先排程下一幀（短間隔），wait() 可再改期
+            self._due = self._last_grab + self.interval
+            self._cond.notify_all()
+        return frame
+
+    def wait(self, timeout):
+        """設定下一幀的就緒時間（從上次取幀起算），實際等待在 grab 中發生"""
+        with self._cond:
+            due = self._last_grab + timeout
+            if self._result is not None and self._result[2] == due:
+                return
+            self._due = due
+            self._result = None
+            self._cond.notify_all()
+
+    def close(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        self.executor.close()
+        self.source.close()
+
+
+# ============ 點擊後變化等待 ============
+
+def tap_watch_regions(frame, click, regions, radius=32):
+    """點擊後要觀察的區域：狀態的比對區域、點擊點附近、整個畫面"""
+    height, width = frame.shape[:2]
+    watch = [tuple(int(v) for v in r) for r in regions]
+    if click:
+        x, y = click
+        watch.append((x - radius, y - radius, x + radius, y + radius))
+    watch.append((0, 0, width, height))
+    return watch
+
+
+def wait_for_change(source, reference, regions, tapped_at, min_delay, timeout, tolerance,
+                    poll=0.05, stop=None):
+    """
+    點擊後高頻截圖，直到觀察區域有明顯變化
+    - 至少等到 tapped_at + min_delay（擬人最短延遲）才返回
+    - 超過 timeout 仍未變化返回 None
+    stop: 返回 True 時中止等待
+    返回變化後的最新畫面，可直接拿來比對
+    """
+    detector = core.FrameChangeDetector(tolerance)
+    detector.changed(reference, regions)  # 點擊前畫面為參考
+    deadline = tapped_at + timeout
+    while time.monotonic() < deadline and not (stop and stop()):
+        source.wait(poll)
+        frame = source.grab()
+        if frame is None or not detector.changed(frame, regions):
+            continue
+        remaining = tapped_at + min_delay - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+            # 等待期間畫面可能繼續變化，取最新一幀
+            latest = source.grab()
+            if latest is not None:
+                frame = latest
+        return frame
+    return None
@@ -11,8 +11,13 @@ import json
 import os
 import sys
 import shutil
+import struct
 import subprocess
+import threading
 from pathlib import Path
+from types import MappingProxyType
+
+import adb_client
 
 
 # ============ 跨平台支援 ============
@@ -110,6 +115,8 @@ SHARED_DIR = DATA_DIR / "shared"
 PROFILES_DIR = DATA_DIR / "profiles"
 ADB_PATH = get_adb_path()
 ADB_LOG_PATH = BASE_DIR / "adb.log"
+# 優先直接連 adb server（TCP 5037），失敗時改用 adb 指令
+USE_NATIVE_ADB = True
 
 # 確保必要目錄存在
 SHARED_DIR.mkdir(parents=True, exist_ok=True)
@@ -148,6 +155,31 @@ DEFAULT_SETTINGS = {
     "miss_threshold": 5,
     "start_delay": 2,
     "click_delay": [0.2, 1.2],
+    "capture_mode": "raw",  # raw: 原始像素（免 PNG 編解碼）, png: screencap -p
+    "capture_source": "screenshot",  # screenshot: 單次截圖, stream: screenrecord 串流（需要 ffmpeg）
+    "pipeline": False,  # 管線化：預取下一幀，點擊在背景執行（網頁運行）
+    "skip_static_frames": True,  # 畫面未變化且上次未匹配時跳過比對
+    "static_tolerance": 2,  # 畫面變化偵測的像素容許差
+    "batch_scoring": True,  # 等尺寸區域一次批次評分
+    "parallel_scoring": False,  # 同一幀的區域評分分散到多個 CPU 核心
+    "search_margin": 0,  # 區域搜尋範圍（像素），容許介面偏移並修正點擊位置；0 為只比對錄製位置
+    "match_budget": 0,  # 每幀比對時間上限（秒），超過時其餘步驟延到下一幀；0 為不限制
+    "coarse_to_fine": False,  # 先以縮小灰階圖粗篩，通過的步驟才以原尺寸確認
+    "coarse_scale": 4,  # 粗篩縮小倍數
+    "coarse_margin": 0.15,  # 粗篩分數低於 閾值 - margin 才淘汰
+    "stat_prefilter": False,  # 比對前先以區域平均/標準差淘汰明顯不符的步驟
+    "stat_mean_tolerance": 40,  # 任一通道平均差超過此值即淘汰
+    "stat_std_ratio": 2.5,  # 標準差相差超過此倍數即淘汰
+    "hash_index": False,  # 以感知雜湊索引找出候選步驟，只有候選步驟才評分
+    "hash_distance": 10,  # 雜湊漢明距離容許值（0-63）
+    "learn_transitions": True,  # 記錄狀態轉移，全部比對模式先比對最可能出現的狀態
+    "adaptive_polling": True,  # 依轉移紀錄預測下一個狀態出現的時間調整截圖間隔（長間隔為上限）
+    "wait_for_change": False,  # 點擊後高頻截圖，畫面一變化就比對（取代固定的點擊延遲）
+    "change_min_delay": [0.15, 0.4],  # 變化等待模式的擬人最短延遲範圍
+    "change_timeout": 3.0,  # 點擊後最多等待畫面變化的秒數
+    "change_tolerance": 8,  # 視為畫面變化的縮圖像素差
+    "input_mode": "input",  # input: Android input 指令, sendevent: 直接寫入觸控事件（較快）
+    "engine": "thread",  # thread: 每個設備一條線程, asyncio: 所有設備共用一個事件迴圈
     "debug": False
 }
 
@@ -189,6 +221,7 @@ def save_profile_config(profile_name, config):
     """儲存 Profile 設定"""
     config_path = get_profile_dir(profile_name) / "config.json"
     save_json(config_path, config)
+    profile_config_cache.update(profile_name, config)
 
 
 def get_states(profile_name):
@@ -202,6 +235,91 @@ def get_template_path(state_name, profile_name):
     return get_profile_dir(profile_name) / "templates" / f"{state_name}.png"
 
 
+# ============ 設定快取 ============
+
+def _freeze(obj):
+    """轉成唯讀結構（dict → MappingProxyType，list → tuple）"""
+    if isinstance(obj, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+
+def _file_stamp(path):
+    """取得檔案戳記 (mtime_ns, size)，檔案不存在返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class ProfileConfigCache:
+    """
+    Profile 設定快取：提供唯讀快照給運行循環
+    - 透過 save_profile_config 寫入時直接更新
+    - 外部修改 config.json 則以 mtime/大小偵測（最多每 CHECK_INTERVAL 秒檢查一次）
+    - 設定未變更時返回同一個快照物件，可用 `is` 判斷是否需要重建衍生資料
+    """
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self):
+        self._entries = {}  # profile -> [檔案戳記, 快照, 上次檢查時間]
+        self._lock = threading.Lock()
+
+    def snapshot(self, profile_name):
+        """取得 Profile 設定的唯讀快照"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(profile_name)
+            if entry and now - entry[2] < self.CHECK_INTERVAL:
+                return entry[1]
+
+        config_path = get_profile_dir(profile_name) / "config.json"
+        stamp = _file_stamp(config_path)
+        if entry and entry[0] == stamp:
+            with self._lock:
+                entry[2] = now
+            return entry[1]
+
+        try:
+            config = load_json(config_path)
+        except (ValueError, OSError):
+            # 外部編輯寫到一半等情況：沿用舊快照，下次再檢查
+            return entry[1] if entry else _freeze({})
+
+        snap = _freeze(config)
+        with self._lock:
+            self._entries[profile_name] = [stamp, snap, now]
+        return snap
+
+    def update(self, profile_name, config):
+        """寫入設定後更新快照"""
+        config_path = get_profile_dir(profile_name) / "config.json"
+        stamp = _file_stamp(config_path)
+        snap = _freeze(config)
+        with self._lock:
+            self._entries[profile_name] = [stamp, snap, time.monotonic()]
+
+    def invalidate(self, profile_name=None):
+        """清除快取（不指定 Profile 時全部清除）"""
+        with self._lock:
+            if profile_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(profile_name, None)
+
+
+# 全局設定快取
+profile_config_cache = ProfileConfigCache()
+
+
+def get_states_snapshot(profile_name):
+    """取得 Profile 所有狀態的唯讀快照（運行循環用）"""
+    return profile_config_cache.snapshot(profile_name).get("states", MappingProxyType({}))
+
+
 # ============ Profile 管理 ============
 
 def create_profile(profile_name):
@@ -225,6 +343,8 @@ def delete_profile(profile_name):
         return False, "Profile 不存在"
 
     shutil.rmtree(profile_dir)
+    profile_config_cache.invalidate(profile_name)
+    template_cache.invalidate(profile_name)
     return True, "刪除成功"
 
 
@@ -262,6 +382,8 @@ def rename_profile(old_name, new_name):
         return False, "新名稱已存在"
 
     old_dir.rename(new_dir)
+    profile_config_cache.invalidate(old_name)
+    template_cache.invalidate(old_name)
     return True, "改名成功"
 
 
@@ -343,28 +465,44 @@ def adb_list_devices():
     列出所有已連接的 ADB 設備
     返回 [{"id": "localhost:5555", "name": "emulator-5554 (localhost:5555)"}, ...]
     """
-    adb_log(f"adb_list_devices: ADB_PATH={ADB_PATH}")
-    try:
-        result = subprocess.run(
-            [ADB_PATH, "devices"],
-            capture_output=True, text=True
-        )
-        adb_log(f"adb_list_devices: returncode={result.returncode}, stdout={result.stdout[:200] if result.stdout else 'None'}")
-    except FileNotFoundError as e:
-        adb_log(f"adb_list_devices: FileNotFoundError - {e}")
-        return []  # ADB 不存在
-    except Exception as e:
-        adb_log(f"adb_list_devices: Exception - {e}")
-        return []
+    raw_devices = None
+    if USE_NATIVE_ADB:
+        try:
+            raw_devices = [serial for serial, status in adb_client.client.devices()
+                           if status == "device"]
+        except (adb_client.AdbError, OSError) as e:
+            adb_log(f"adb_list_devices: native 失敗，改用 adb 指令 - {e}")
+
+    if raw_devices is None:
+        adb_log(f"adb_list_devices: ADB_PATH={ADB_PATH}")
+        try:
+            result = subprocess.run(
+                [ADB_PATH, "devices"],
+                capture_output=True, text=True
+            )
+            adb_log(f"adb_list_devices: returncode={result.returncode}, stdout={result.stdout[:200] if result.stdout else 'None'}")
+        except FileNotFoundError as e:
+            adb_log(f"adb_list_devices: FileNotFoundError - {e}")
+            return []  # ADB 不存在
+        except Exception as e:
+            adb_log(f"adb_list_devices: Exception - {e}")
+            return []
+
+        raw_devices = []
+        for line in result.stdout.strip().split("\n")[1:]:  # 跳過標題行
+            if "\t" in line:
+                device_id, status = line.split("\t")
+                if status == "device":
+                    raw_devices.append(device_id)
+
+    return format_devices(raw_devices)
 
-    raw_devices = []
-    for line in result.stdout.strip().split("\n")[1:]:  # 跳過標題行
-        if "\t" in line:
-            device_id, status = line.split("\t")
-            if status == "device":
-                raw_devices.append(device_id)
 
-    # 整理設備列表
+def format_devices(raw_devices):
+    """
+    整理設備序號列表（emulator-5554 轉為 localhost:5555，去除重複）
+    返回 [{"id": "localhost:5555", "name": "emulator-5554 (localhost:5555)"}, ...]
+    """
     devices = []
     seen_ports = set()
 
@@ -402,6 +540,11 @@ def adb_list_devices():
 def adb_connect(host="localhost", port=5555):
     """連接 ADB"""
     addr = f"{host}:{port}"
+    if USE_NATIVE_ADB:
+        try:
+            return "connected" in adb_client.client.connect(addr).lower()
+        except (adb_client.AdbError, OSError) as e:
+            adb_log(f"adb_connect({addr}): native 失敗，改用 adb 指令 - {e}")
     try:
         result = subprocess.run(
             [ADB_PATH, "connect", addr],
@@ -418,19 +561,33 @@ def adb_connect(host="localhost", port=5555):
 
 def adb_get_resolution(device="localhost:5555"):
     """取得 Android 解析度"""
-    try:
-        result = subprocess.run(
-            [ADB_PATH, "-s", device, "shell", "wm", "size"],
-            capture_output=True, text=True
-        )
-    except FileNotFoundError as e:
-        adb_log(f"adb_get_resolution({device}): FileNotFoundError - {e}")
-        return None, None
-    except Exception as e:
-        adb_log(f"adb_get_resolution({device}): Exception - {e}")
-        return None, None
-    if result.returncode == 0:
-        for line in result.stdout.strip().split("\n"):
+    output = None
+    if USE_NATIVE_ADB:
+        try:
+            returncode, output = adb_client.pool.shell(device, "wm size")
+            if returncode != 0:
+                return None, None
+        except (adb_client.AdbError, OSError) as e:
+            adb_log(f"adb_get_resolution({device}): native 失敗，改用 adb 指令 - {e}")
+
+    if output is None:
+        try:
+            result = subprocess.run(
+                [ADB_PATH, "-s", device, "shell", "wm", "size"],
+                capture_output=True, text=True
+            )
+        except FileNotFoundError as e:
+            adb_log(f"adb_get_resolution({device}): FileNotFoundError - {e}")
+            return None, None
+        except Exception as e:
+            adb_log(f"adb_get_resolution({device}): Exception - {e}")
+            return None, None
+        if result.returncode != 0:
+            return None, None
+        output = result.stdout
+
+    if output:
+        for line in output.strip().split("\n"):
             if "Physical size" in line:
                 size_str = line.split(":")[-1].strip()
                 w, h = map(int, size_str.split("x"))
@@ -438,41 +595,160 @@ def adb_get_resolution(device="localhost:5555"):
     return None, None
 
 
-def adb_tap(x, y, device="localhost:5555"):
-    """ADB 點擊指定座標"""
+def adb_shell(cmd, device="localhost:5555"):
+    """在設備執行 shell 指令（走持久 shell），返回 (returncode, 輸出)，失敗返回 (None, None)"""
+    if USE_NATIVE_ADB:
+        try:
+            return adb_client.pool.shell(device, cmd)
+        except adb_client.AdbCommandSentError as e:
+            # 指令可能已執行（例如點擊），不再以 adb 指令重送
+            adb_log(f"adb_shell({device}, {cmd[:80]}): {e}")
+            return None, None
+        except (adb_client.AdbError, OSError) as e:
+            adb_log(f"adb_shell({device}, {cmd[:80]}): native 失敗，改用 adb 指令 - {e}")
     try:
         result = subprocess.run(
-            [ADB_PATH, "-s", device, "shell", "input", "tap", str(x), str(y)],
+            [ADB_PATH, "-s", device, "shell", cmd],
             capture_output=True, text=True
         )
-        return result.returncode == 0
+        return result.returncode, result.stdout
     except FileNotFoundError as e:
-        adb_log(f"adb_tap({x},{y},{device}): FileNotFoundError - {e}")
-        return False
+        adb_log(f"adb_shell({device}, {cmd[:80]}): FileNotFoundError - {e}")
+        return None, None
     except Exception as e:
-        adb_log(f"adb_tap({x},{y},{device}): Exception - {e}")
-        return False
+        adb_log(f"adb_shell({device}, {cmd[:80]}): Exception - {e}")
+        return None, None
+
+
+def adb_tap(x, y, device="localhost:5555", mode="input", screen=None):
+    """
+    ADB 點擊指定座標
+    mode: input 使用 Android input 指令, sendevent 直接寫入觸控事件（見 touch.py）
+    screen: 點擊依據的畫面尺寸 (h, w)，sendevent 依此判斷是否需要重新讀取螢幕方向
+    """
+    import touch
+    channel = touch.get_channel(device, mode)
+    if screen is not None:
+        channel.observe(screen)
+    return channel.tap(x, y)
+
+
+def adb_swipe(x1, y1, x2, y2, duration=0.3, device="localhost:5555", mode="input"):
+    """ADB 滑動（duration 秒）"""
+    import touch
+    return touch.get_channel(device, mode).swipe(x1, y1, x2, y2, duration)
+
+
+def adb_long_press(x, y, duration=0.8, device="localhost:5555", mode="input"):
+    """ADB 長按（duration 秒）"""
+    import touch
+    return touch.get_channel(device, mode).long_press(x, y, duration)
 
 
-def adb_screenshot(device="localhost:5555"):
-    """使用 ADB 截取 Android 畫面"""
+def adb_exec_out(device, cmd):
+    """執行 adb exec-out 並返回原始輸出，失敗返回 None"""
+    if USE_NATIVE_ADB:
+        try:
+            return adb_client.pool.exec_out(device, cmd)
+        except (adb_client.AdbError, OSError) as e:
+            adb_log(f"adb_exec_out({device}, {cmd}): native 失敗，改用 adb 指令 - {e}")
     try:
         result = subprocess.run(
-            [ADB_PATH, "-s", device, "exec-out", "screencap", "-p"],
+            [ADB_PATH, "-s", device, "exec-out"] + cmd.split(),
             capture_output=True
         )
     except FileNotFoundError as e:
-        adb_log(f"adb_screenshot({device}): FileNotFoundError - {e}")
+        adb_log(f"adb_exec_out({device}, {cmd}): FileNotFoundError - {e}")
         return None
     except Exception as e:
-        adb_log(f"adb_screenshot({device}): Exception - {e}")
+        adb_log(f"adb_exec_out({device}, {cmd}): Exception - {e}")
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout
+
+
+# screencap 原始格式 (android PixelFormat) -> 轉 BGR 的 cvtColor 代碼
+_RAW_PIXEL_FORMATS = {
+    1: cv2.COLOR_RGBA2BGR,  # RGBA_8888
+    2: cv2.COLOR_RGBA2BGR,  # RGBX_8888
+    5: cv2.COLOR_BGRA2BGR,  # BGRA_8888
+}
+
+
+def parse_screencap_raw(data):
+    """
+    解析 screencap（無 -p）的原始輸出
+    標頭: width, height, format（Android 9+ 另有 colorspace）各 4 bytes
+    返回 (像素 view (h, w, 4), format)，不複製資料；格式不支援返回 None
+    """
+    if not data or len(data) < 12:
         return None
-    if result.returncode != 0 or not result.stdout:
+    width, height, fmt = struct.unpack_from("<III", data, 0)
+    size = width * height * 4
+    header_size = len(data) - size
+    if header_size not in (12, 16) or fmt not in _RAW_PIXEL_FORMATS:
         return None
+    pixels = np.frombuffer(data, dtype=np.uint8, count=size, offset=header_size)
+    return pixels.reshape(height, width, 4), fmt
+
 
-    img_array = np.frombuffer(result.stdout, dtype=np.uint8)
-    img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-    return img
+def screencap_raw_to_bgr(data):
+    """screencap 原始輸出轉成 BGR 圖片，無法解析返回 None"""
+    raw = parse_screencap_raw(data)
+    if raw is None:
+        return None
+    pixels, fmt = raw
+    return cv2.cvtColor(pixels, _RAW_PIXEL_FORMATS[fmt])
+
+
+def decode_png(data):
+    """screencap -p 的 PNG 輸出解碼成 BGR 圖片，失敗返回 None"""
+    if not data:
+        return None
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def adb_screenshot_raw(device="localhost:5555"):
+    """
+    截取原始像素（裝置端不壓縮、主機端不解碼）
+    返回 (像素 view (h, w, 4), format) 或 None
+    """
+    return parse_screencap_raw(adb_exec_out(device, "screencap"))
+
+
+_raw_unsupported = set()  # 原始格式無法解析的設備（RGB_565 等），之後直接用 PNG
+
+
+def raw_capture_supported(device):
+    """設備是否可用原始像素截圖（尚未解析失敗過）"""
+    return device not in _raw_unsupported
+
+
+def raw_capture_failed(device, data):
+    """
+    原始輸出無法解析時記錄設備，之後不再先拉一次原始緩衝區
+    沒有收到資料（連線失敗等）不算，下次仍嘗試原始格式
+    """
+    if data and device not in _raw_unsupported:
+        _raw_unsupported.add(device)
+        header = struct.unpack_from("<III", data, 0) if len(data) >= 12 else None
+        adb_log(f"adb_screenshot({device}): 不支援的原始格式 (width, height, format)={header}，改用 PNG")
+
+
+def adb_screenshot(device="localhost:5555", mode="raw"):
+    """
+    使用 ADB 截取 Android 畫面，返回 BGR 圖片
+    mode: raw 原始像素（格式不支援時改用 png，並記住該設備）, png 使用 screencap -p
+    """
+    if mode == "raw" and raw_capture_supported(device):
+        data = adb_exec_out(device, "screencap")
+        img = screencap_raw_to_bgr(data)
+        if img is not None:
+            return img
+        raw_capture_failed(device, data)
+
+    return decode_png(adb_exec_out(device, "screencap -p"))
 
 
 def adb_save_template(name, profile_name, device="localhost:5555"):
@@ -694,6 +970,34 @@ def get_regions(state_config):
     return []
 
 
+CHECK_UNITS = ("frames", "seconds")
+
+
+def get_check_frequency(state_config):
+    """取得狀態的檢查頻率 (間隔, 單位)，未設定時為每幀 (1, "frames")"""
+    return state_config.get("check_every", 1), state_config.get("check_unit", "frames")
+
+
+def set_check_frequency(state_config, every, unit="frames"):
+    """
+    設定狀態的檢查頻率（每 every 幀或每 every 秒比對一次）
+    每幀比對時移除欄位；數值無效時拋出 ValueError
+    """
+    if unit not in CHECK_UNITS:
+        raise ValueError(f"無效單位: {unit}")
+    every = float(every)
+    if unit == "frames":
+        every = int(every)
+    if every <= 0:
+        raise ValueError("間隔必須大於 0")
+    if unit == "frames" and every == 1:
+        state_config.pop("check_every", None)
+        state_config.pop("check_unit", None)
+    else:
+        state_config["check_every"] = every
+        state_config["check_unit"] = unit
+
+
 def crop_region(img, region):
     """從圖片裁切指定區域"""
     left, top, right, bottom = region
@@ -722,92 +1026,157 @@ def match_region(frame_region, template_region):
     return max_val
 
 
-def load_templates(profile_name, states):
-    """載入所有狀態模板"""
-    templates = {}
+# ============ 畫面變化偵測 ============
+
+class FrameChangeDetector:
+    """
+    畫面變化偵測：比較各比對區域的縮圖（最大 16x16）
+    與上次實際比對時的畫面相比，所有縮圖像素差都不超過 tolerance 即視為未變化
+    """
+    THUMB_SIZE = 16
+
+    def __init__(self, tolerance=2):
+        self.tolerance = tolerance
+        self._reference = None
+        self._regions = None
+
+    def fingerprint(self, frame, regions):
+        """計算區域縮圖指紋"""
+        parts = []
+        for region in regions:
+            cropped = crop_region(frame, region)
+            if cropped is None:
+                continue
+            h, w = cropped.shape[:2]
+            size = (min(w, self.THUMB_SIZE), min(h, self.THUMB_SIZE))
+            parts.append(cv2.resize(cropped, size, interpolation=cv2.INTER_AREA).ravel())
+        if not parts:
+            return None
+        return np.concatenate(parts).astype(np.int16)
+
+    def changed(self, frame, regions):
+        """畫面相對於參考畫面是否有變化；有變化時更新參考畫面"""
+        fp = self.fingerprint(frame, regions)
+        if (fp is not None and self._reference is not None and regions == self._regions
+                and fp.shape == self._reference.shape
+                and np.abs(fp - self._reference).max() <= self.tolerance):
+            return False
+        self._reference = fp
+        self._regions = regions
+        return True
+
+    def reset(self):
+        self._reference = None
+        self._regions = None
 
-    for state_name, state_config in states.items():
-        if not state_config.get("enabled", True):
-            print(f"  跳過: {state_name} (disabled)")
-            continue
 
+# ============ 模板快取 ============
+
+class TemplateCache:
+    """
+    模板快取：保留解碼後的區域裁切
+    模板檔案（mtime/大小）或區域設定變更時才重新讀取
+    """
+    def __init__(self):
+        self._entries = {}  # (profile, state) -> (檔案戳記, 區域, (模板尺寸, 裁切列表))
+        self._lock = threading.Lock()
+
+    def get(self, profile_name, state_name, regions):
+        """
+        取得模板尺寸與各區域裁切
+        返回 ((h, w), [crop, ...])，讀取失敗返回 None
+        超出範圍的區域在列表中為 None；沒有區域時列表只有全畫面
+        """
+        key = (profile_name, state_name)
         path = get_template_path(state_name, profile_name)
-        if not path.exists():
-            print(f"  缺少: {state_name}.png")
-            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            with self._lock:
+                self._entries.pop(key, None)
+            return None
+
+        stamp = (st.st_mtime_ns, st.st_size)
+        regions_key = tuple(tuple(r) for r in regions)
+
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] == stamp and entry[1] == regions_key:
+            return entry[2]
 
         img = imread_safe(path)
         if img is None:
-            print(f"  警告: 無法讀取 {path}")
-            continue
-
-        regions = get_regions(state_config)
+            return None
 
-        if regions:
-            region_templates = []
-            for i, region in enumerate(regions):
+        if regions_key:
+            # 複製裁切，不保留整張全畫面模板
+            crops = []
+            for region in regions_key:
                 cropped = crop_region(img, region)
-                if cropped is None:
-                    print(f"  警告: {state_name} region[{i}] 無效")
-                    continue
-                region_templates.append(cropped)
-
-            if not region_templates:
-                print(f"  警告: {state_name} 沒有有效區域，跳過")
-                continue
-
-            templates[state_name] = region_templates
-            print(f"  載入: {state_name} ({len(region_templates)} 個區域)")
+                crops.append(cropped.copy() if cropped is not None else None)
         else:
-            templates[state_name] = [img]
-            print(f"  載入: {state_name} (全畫面)")
+            # 沒有區域：使用全畫面
+            crops = [img]
+
+        value = (img.shape[:2], crops)
+        with self._lock:
+            self._entries[key] = (stamp, regions_key, value)
+        return value
+
+    def entries(self, profile_name):
+        """列出 Profile 已快取的項目 [(state, 檔案戳記, 區域, (模板尺寸, 裁切列表)), ...]"""
+        with self._lock:
+            return [(k[1],) + entry for k, entry in self._entries.items() if k[0] == profile_name]
+
+    def put(self, profile_name, state_name, stamp, regions, value):
+        """直接放入已解碼的項目（例如共享記憶體中的模板），檔案戳記不符時 get 會重新讀取"""
+        with self._lock:
+            self._entries[(profile_name, state_name)] = (stamp, tuple(tuple(r) for r in regions), value)
+
+    def invalidate(self, profile_name=None):
+        """清除快取（不指定 Profile 時全部清除）"""
+        with self._lock:
+            if profile_name is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == profile_name]:
+                    del self._entries[key]
+
 
-    return templates
+# 全局模板快取
+template_cache = TemplateCache()
 
 
-def match_state(current_frame, templates, states, threshold):
-    """比對當前畫面與所有模板"""
-    best_match = None
-    best_confidence = 0
-    all_scores = {}
+# ============ 自動化核心 ============
 
-    for state_name, template_list in templates.items():
-        state_config = states[state_name]
+def build_cli_plan(profile_name, states, settings):
+    """編譯 CLI 用的比對計畫（沒有區域的狀態以全畫面比對），並印出載入結果"""
+    import matcher
+    plan = matcher.build_plan(profile_name, states, settings, allow_fullscreen=True)
 
+    for state_name, state_config in states.items():
         if not state_config.get("enabled", True):
-            continue
-
-        regions = get_regions(state_config)
-        region_scores = []
-
-        if regions:
-            for i, (region, template) in enumerate(zip(regions, template_list)):
-                frame_region = crop_region(current_frame, region)
-                if frame_region is None:
-                    region_scores.append(0)
-                    continue
-                score = match_region(frame_region, template)
-                region_scores.append(score)
+            print(f"  跳過: {state_name} (disabled)")
+    for i, state_name in enumerate(plan.names):
+        if state_name in plan.errors:
+            print(f"  警告: {state_name} {plan.errors[state_name]}，跳過")
+        elif plan.fullscreen[i]:
+            print(f"  載入: {state_name} (全畫面)")
         else:
-            score = match_region(current_frame, template_list[0])
-            region_scores.append(score)
-
-        min_score = min(region_scores) if region_scores else 0
-        all_scores[state_name] = min_score
+            count = plan.state_starts[i + 1] - plan.state_starts[i]
+            print(f"  載入: {state_name} ({count} 個區域)")
+    if plan.shared_regions:
+        print(f"  共用區域: {plan.shared_regions} 個（每幀只比對一次）")
+    return plan
 
-        if min_score >= threshold and min_score > best_confidence:
-            best_confidence = min_score
-            best_match = state_name
-
-    return best_match, best_confidence, all_scores
-
-
-# ============ 自動化核心 ============
 
-def run_automation(profile_name, stop_event=None):
-    """執行自動化"""
+def run_automation(profile_name, stop_event=None, shared=None):
+    """
+    執行自動化
+    shared: 併行運行時主行程的共享資源（shm.SharedSession.handle），模板與畫面改用共享記憶體
+    """
     settings = get_shared_settings()
-    states = get_states(profile_name)
+    states = get_states_snapshot(profile_name)
 
     if not states:
         print("錯誤: 此 Profile 沒有任何狀態")
@@ -850,13 +1219,18 @@ def run_automation(profile_name, stop_event=None):
     print(f"\n=== Profile: {profile_name} ===")
     print("載入狀態模板...")
 
-    templates = load_templates(profile_name, states)
+    if shared:
+        import shm
+        count = shm.attach_templates(shared["templates"])
+        print(f"  共享模板: {count} 個狀態")
+
+    plan = build_cli_plan(profile_name, states, settings)
 
-    if not templates:
+    if not plan.valid.any():
         print("錯誤: 沒有可用的模板")
         return
 
-    print(f"\n已載入 {len(templates)} 個狀態")
+    print(f"\n已載入 {int(plan.valid.sum())} 個狀態")
     print(f"閾值: {threshold} | 短間隔: {short_interval}s | 長間隔: {long_interval}s | Debug: {debug}")
     print(f"\n{start_delay} 秒後開始運行...")
     print("按 Ctrl+C 停止\n")
@@ -864,35 +1238,73 @@ def run_automation(profile_name, stop_event=None):
 
     print("開始監控...\n")
 
+    import capture
+    import history
+    if shared and shared["frames"]:
+        source = shm.SharedFrameSource(shared["frames"])
+    else:
+        source = capture.open_frame_source("localhost:5555", settings)
+    transitions = history.open_history(profile_name) if settings.get("learn_transitions") else None
+    last_state = None
+    last_tap_time = None
+    scheduler = None
+    if settings.get("adaptive_polling"):
+        scheduler = history.PollScheduler(transitions, short_interval, long_interval, miss_threshold)
+
     consecutive_misses = 0
     using_long_interval = False
+    pending_frame = None  # 點擊後偵測到變化的畫面，下一輪直接比對
 
     try:
         while True:
             if stop_event and stop_event.is_set():
                 break
 
-            current_frame = adb_screenshot()
+            current_frame = pending_frame if pending_frame is not None else source.grab()
+            pending_frame = None
             if current_frame is None:
                 print("警告: ADB 截圖失敗")
                 time.sleep(short_interval)
                 continue
 
-            state, confidence, all_scores = match_state(
-                current_frame, templates, states, threshold
-            )
+            # 設定或模板變更時重新編譯比對計畫
+            states = get_states_snapshot(profile_name)
+            if not plan.is_current(states):
+                print("偵測到設定變更，重新載入狀態模板...")
+                plan = build_cli_plan(profile_name, states, settings)
+
+            best, confidence, all_scores = plan.best_match(current_frame)
+            state = plan.names[best] if best is not None else None
 
             if debug:
                 scores_str = " | ".join([f"{k}: {v:.2f}" for k, v in all_scores.items()])
-                interval_mode = "長" if using_long_interval else "短"
+                interval_mode = "自適應" if scheduler else ("長" if using_long_interval else "短")
                 print(f"[DEBUG] [{interval_mode}] {scores_str}")
 
             if state:
-                click_x, click_y = states[state]["click"]
-                adb_tap(click_x, click_y)
-                delay = random.uniform(click_delay[0], click_delay[1])
-                time.sleep(delay)
+                if transitions:
+                    elapsed = time.monotonic() - last_tap_time if last_tap_time else None
+                    transitions.record(last_state, state, elapsed)
+                last_state = state
+
+                click_x, click_y = plan.click_at(current_frame, best)
+                adb_tap(click_x, click_y, mode=settings["input_mode"], screen=current_frame.shape)
+                last_tap_time = time.monotonic()
+                if scheduler:
+                    scheduler.matched(state)
                 print(f">>> [{state}] {confidence:.2f} -> 點擊 ({click_x}, {click_y})")
+                if settings.get("wait_for_change"):
+                    # 等到畫面變化（至少擬人最短延遲）
+                    pending_frame = capture.wait_for_change(
+                        source, current_frame,
+                        capture.tap_watch_regions(current_frame, (click_x, click_y), plan.state_regions(best)),
+                        last_tap_time, random.uniform(*settings["change_min_delay"]),
+                        settings["change_timeout"], settings["change_tolerance"],
+                        stop=stop_event.is_set if stop_event else None
+                    )
+                else:
+                    delay = random.uniform(click_delay[0], click_delay[1])
+                    time.sleep(delay)
 
                 consecutive_misses = 0
                 if using_long_interval:
@@ -900,12 +1312,21 @@ def run_automation(profile_name, stop_event=None):
                     print("切換到短間隔模式")
             else:
                 consecutive_misses += 1
-                if not using_long_interval and consecutive_misses >= miss_threshold:
+                if not scheduler and not using_long_interval and consecutive_misses >= miss_threshold:
                     using_long_interval = True
                     print(f"連續 {miss_threshold} 次未命中，切換到長間隔模式")
 
-            current_interval = long_interval if using_long_interval else short_interval
-            time.sleep(current_interval)
+            if pending_frame is not None:
+                continue
+            if scheduler:
+                current_interval = scheduler.next_interval(state is not None)
+            else:
+                current_interval = long_interval if using_long_interval else short_interval
+            source.wait(current_interval)
 
     except KeyboardInterrupt:
         print("\n\n已停止運行")
+    finally:
+        source.close()
+        if transitions:
+            history.close_history(transitions)
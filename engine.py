@@ -0,0 +1,150 @@
+"""
+asyncio 引擎：單一事件迴圈驅動多個設備
+- ADB 截圖與點擊走非同步 socket（adb server 協定），等待期間不佔線程
+- 解碼與比對等 CPU 工作交給有上限的線程池
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import adb_client
+import core
+
+
+class AsyncAdb:
+    """非同步 adb server 協定客戶端；無法連線時改用非同步 adb 子行程"""
+    def __init__(self, host=adb_client.ADB_HOST, port=adb_client.ADB_PORT, timeout=10.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    async def _open(self, request):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+        try:
+            await self._request(reader, writer, request)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _request(self, reader, writer, request):
+        writer.write(adb_client._encode_request(request))
+        await writer.drain()
+        status = await reader.readexactly(4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            length = int(await reader.readexactly(4), 16)
+            raise adb_client.AdbError((await reader.readexactly(length)).decode("utf-8", "replace"))
+        raise adb_client.AdbError(f"未知回應: {status!r}")
+
+    async def _service(self, serial, service):
+        """切換到設備 transport 後開啟服務，讀取到連線結束"""
+        reader, writer = await self._open(f"host:transport:{serial}")
+        try:
+            await self._request(reader, writer, service)
+            return await asyncio.wait_for(reader.read(), self.timeout)
+        finally:
+            writer.close()
+
+    async def _subprocess(self, *args):
+        proc = await asyncio.create_subprocess_exec(
+            core.ADB_PATH, *args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await proc.communicate()
+        return proc.returncode, stdout
+
+    async def connect(self, addr):
+        """等同 adb connect，成功返回 True"""
+        if core.USE_NATIVE_ADB:
+            try:
+                reader, writer = await self._open(f"host:connect:{addr}")
+                try:
+                    length = int(await reader.readexactly(4), 16)
+                    message = (await reader.readexactly(length)).decode("utf-8", "replace")
+                finally:
+                    writer.close()
+                return "connected" in message.lower()
+            except (adb_client.AdbError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                core.adb_log(f"AsyncAdb.connect({addr}): native 失敗，改用 adb 指令 - {e}")
+        try:
+            _, stdout = await self._subprocess("connect", addr)
+        except OSError as e:
+            core.adb_log(f"AsyncAdb.connect({addr}): {e}")
+            return False
+        return b"connected" in stdout.lower()
+
+    async def exec_out(self, serial, cmd):
+        """等同 adb exec-out，返回原始輸出，失敗返回 None"""
+        if core.USE_NATIVE_ADB:
+            try:
+                return await self._service(serial, f"exec:{cmd}")
+            except (adb_client.AdbError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                core.adb_log(f"AsyncAdb.exec_out({serial}, {cmd}): native 失敗，改用 adb 指令 - {e}")
+        try:
+            returncode, stdout = await self._subprocess("-s", serial, "exec-out", *cmd.split())
+        except OSError as e:
+            core.adb_log(f"AsyncAdb.exec_out({serial}, {cmd}): {e}")
+            return None
+        return stdout if returncode == 0 else None
+
+    async def tap(self, serial, x, y, channel=None):
+        """點擊指定座標（channel: 已 prepare 的 touch.InputChannel，決定指令組合方式）"""
+        if channel:
+            # 組合指令可能要讀取螢幕方向（同步 ADB），不在事件迴圈中執行
+            cmd = await asyncio.get_running_loop().run_in_executor(None, channel.script, [("tap", x, y)])
+        else:
+            cmd = f"input tap {x} {y}"
+        output = await self.exec_out(serial, cmd)
+        return output is not None
+
+
+class Engine:
+    """
+    事件迴圈在一條背景線程執行，所有設備的協程共用
+    compute() 把 CPU 工作交給線程池（OpenCV/numpy 運算會釋放 GIL）
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or min(8, os.cpu_count() or 4)
+        self.adb = AsyncAdb()
+        self.loop = None
+        self.pool = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self.loop is not None:
+                return
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="engine-worker")
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self._thread.start()
+
+    def submit(self, coro):
+        """在引擎的事件迴圈執行協程，返回 concurrent.futures.Future"""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def compute(self, fn, *args):
+        """在線程池執行 CPU 工作"""
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def screenshot(self, serial, mode="raw"):
+        """截圖並在線程池解碼，返回 BGR 圖片，失敗返回 None"""
+        if mode == "raw" and core.raw_capture_supported(serial):
+            data = await self.adb.exec_out(serial, "screencap")
+            img = await self.compute(core.screencap_raw_to_bgr, data)
+            if img is not None:
+                return img
+            core.raw_capture_failed(serial, data)
+        return await self.compute(core.decode_png, await self.adb.exec_out(serial, "screencap -p"))
+
+
+# 全局引擎（第一次使用時啟動）
+engine = Engine()
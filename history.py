@@ -0,0 +1,173 @@
+"""
+運行紀錄：狀態轉移統計
+"""
+
+import threading
+import time
+
+import core
+
+START = ""  # 運行開始（尚無前一個狀態）
+
+
+class TransitionHistory:
+    """
+    記錄「前一個匹配狀態 → 下一個匹配狀態」的次數與間隔（點擊到下一次匹配的秒數）
+    存於 Profile 目錄的 transitions.json，下次運行沿用
+    """
+    FILE_NAME = "transitions.json"
+    MAX_COUNT = 1000  # 同一前狀態的總次數超過時全部減半，舊紀錄逐漸淡出
+    SAVE_EVERY = 20  # 每記錄幾次寫入一次檔案
+    ALPHA = 0.2  # 間隔的指數平均權重
+
+    def __init__(self, profile_name):
+        self.profile_name = profile_name
+        self.path = core.get_profile_dir(profile_name) / self.FILE_NAME
+        data = core.load_json(self.path, {})
+        # 前狀態 -> {下一狀態: {"count": 次數, "mean": 平均間隔, "dev": 平均偏差}}
+        self.transitions = data.get("transitions", {})
+        self._dirty = 0
+        self._lock = threading.Lock()
+
+    def record(self, prev, state_name, elapsed=None):
+        """記錄一次轉移（prev 為 None 表示運行開始）"""
+        with self._lock:
+            row = self.transitions.setdefault(prev or START, {})
+            entry = row.setdefault(state_name, {"count": 0, "mean": None, "dev": 0.0})
+            entry["count"] += 1
+            if elapsed is not None:
+                if entry["mean"] is None:
+                    entry["mean"] = elapsed
+                else:
+                    error = elapsed - entry["mean"]
+                    entry["mean"] += self.ALPHA * error
+                    entry["dev"] += self.ALPHA * (abs(error) - entry["dev"])
+
+            if sum(e["count"] for e in row.values()) > self.MAX_COUNT:
+                for e in row.values():
+                    e["count"] /= 2
+
+            self._dirty += 1
+            should_save = self._dirty >= self.SAVE_EVERY
+        if should_save:
+            self.save()
+
+    def delays(self, prev):
+        """返回 [(次數, 平均間隔, 平均偏差), ...]（只含有間隔紀錄的轉移）"""
+        with self._lock:
+            row = self.transitions.get(prev or START, {})
+            return [(e["count"], e["mean"], e["dev"]) for e in row.values() if e["mean"] is not None]
+
+    def counts(self, prev):
+        """返回 {下一狀態: 次數}"""
+        with self._lock:
+            row = self.transitions.get(prev or START, {})
+            return {name: e["count"] for name, e in row.items()}
+
+    def order(self, prev, plan):
+        """
+        依可能性排序步驟索引：優先度高者優先，其次轉移次數多者，同分維持設定順序
+        """
+        counts = self.counts(prev)
+        return sorted(
+            range(len(plan.names)),
+            key=lambda i: (-plan.priority[i], -counts.get(plan.names[i], 0), i)
+        )
+
+    def save(self):
+        """寫入檔案（有新紀錄時）"""
+        with self._lock:
+            # Profile 已刪除或改名時不重建目錄
+            if not self._dirty or not self.path.parent.exists():
+                return
+            data = {"transitions": self.transitions}
+            self._dirty = 0
+            try:
+                core.save_json(self.path, data)
+            except OSError as e:
+                core.adb_log(f"TransitionHistory: 無法儲存 {self.path}: {e}")
+
+
+_histories = {}  # Profile -> [TransitionHistory, 使用中的運行數]
+_histories_lock = threading.Lock()
+
+
+def open_history(profile_name):
+    """
+    取得 Profile 的轉移統計：同一行程內同時運行同一 Profile 的設備共用一份
+    （各自讀寫 transitions.json 會互相覆蓋），用完以 close_history 釋放
+    """
+    with _histories_lock:
+        entry = _histories.get(profile_name)
+        if entry is None:
+            entry = _histories[profile_name] = [TransitionHistory(profile_name), 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def close_history(transitions):
+    """釋放 open_history 取得的統計並寫入檔案；最後一個使用者釋放時移除共用實例"""
+    with _histories_lock:
+        entry = _histories.get(transitions.profile_name)
+        if entry is not None and entry[0] is transitions:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del _histories[transitions.profile_name]
+    transitions.save()
+
+
+class PollScheduler:
+    """
+    自適應輪詢：依轉移紀錄預測下一個狀態出現的時間，取代固定的短/長間隔
+    - 預測時間窗（平均間隔 ± 2 倍偏差）內以 base 密集截圖
+    - 時間窗外指數退避，但不會睡過下一個時間窗的開始
+    - 沒有紀錄時，連續 dense_misses 次未匹配後才開始退避
+    - 任何情況都不超過 cap（最差延遲）
+    """
+    BACKOFF = 2.0
+
+    def __init__(self, transitions, base, cap, dense_misses):
+        self.transitions = transitions
+        self.base = base
+        self.cap = max(cap, base)
+        self.dense_misses = dense_misses
+        self.last_state = None
+        self.last_tap = time.monotonic()
+        self.misses = 0
+        self._interval = base
+
+    def matched(self, state_name):
+        """匹配並點擊後呼叫，重新開始計時"""
+        self.last_state = state_name
+        self.last_tap = time.monotonic()
+        self.misses = 0
+        self._interval = self.base
+
+    def _windows(self):
+        """預測的出現時間窗 [(開始, 結束), ...]（相對於上次點擊）"""
+        if not self.transitions:
+            return []
+        return [
+            (mean - 2 * dev - self.base, mean + 2 * dev + self.base)
+            for _, mean, dev in self.transitions.delays(self.last_state)
+        ]
+
+    def next_interval(self, matched=False):
+        """下一次截圖前的等待秒數"""
+        if not matched:
+            self.misses += 1
+        elapsed = time.monotonic() - self.last_tap
+        windows = self._windows()
+
+        if any(start <= elapsed <= end for start, end in windows):
+            self._interval = self.base
+            return self.base
+        if not windows and self.misses < self.dense_misses:
+            return self.base
+
+        interval = self._interval
+        self._interval = min(self._interval * self.BACKOFF, self.cap)
+        upcoming = [start - elapsed for start, _ in windows if start > elapsed]
+        if upcoming:
+            interval = min(interval, max(self.base, min(upcoming)))
+        return min(interval, self.cap)
@@ -0,0 +1,865 @@
+"""
+比對引擎：批次評分、感知雜湊索引、比對計畫
+"""
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import core
+
+GATHER_CHUNK = 1 << 18  # 批次評分每段緩衝區的元素數（float32 1MB），區域很多時分段評分
+
+
+def template_vector(tpl):
+    """
+    模板轉成「各通道去平均、整體單位長度」的通道優先 float32 向量
+    返回 (去平均後的長度, 向量)；長度為 0（單色模板）時向量不縮放
+    """
+    t = tpl.astype(np.float32)
+    t -= t.reshape(-1, t.shape[-1]).mean(axis=0) if t.ndim == 3 else t.mean()
+    norm = float(np.sqrt(np.square(t, dtype=np.float64).sum()))
+    flat = np.moveaxis(t, -1, 0).ravel() if t.ndim == 3 else t.ravel()
+    if norm > 0:
+        flat /= norm
+    return norm, flat
+
+
+_template_vectors = {}  # (Profile, 步驟) -> (模板裁切列表, [template_vector, ...])
+_template_vectors_lock = threading.Lock()
+
+
+def put_template_vectors(profile_name, state_name, crops, vectors):
+    """登記已計算的模板向量（例如共享記憶體中的向量），MatchPlan 遇到同一份裁切時直接使用"""
+    with _template_vectors_lock:
+        _template_vectors[(profile_name, state_name)] = (crops, vectors)
+
+
+def get_template_vectors(profile_name, state_name, crops):
+    """取得已登記的模板向量；沒有登記或模板已重新讀取（裁切不是同一份）時返回 None"""
+    with _template_vectors_lock:
+        entry = _template_vectors.get((profile_name, state_name))
+    return entry[1] if entry and entry[0] is crops else None
+
+
+class BatchScorer:
+    """
+    等尺寸區域批次評分
+    - 模板預先轉成 template_vector（每個模板只保留這一份 float32 向量）
+    - 每幀把區域依序複製到 float32 緩衝區，再以分段加總算出所有區域的 TM_CCOEFF_NORMED
+      （緩衝區最多 GATHER_CHUNK 個元素，超過時分段處理，記憶體不隨區域數增加）
+    - 畫面區域與模板尺寸不同時（解析度不符等），該區域改用 core.match_region
+    因模板各通道已去平均，分子 Σ t̂·(I - mean) 等於 Σ t̂·I，不需要對畫面去平均
+    """
+    def __init__(self, regions, templates, vectors=None):
+        """
+        regions: [(left, top, right, bottom), ...]
+        templates: 對應的模板裁切 (h, w, c) uint8
+        vectors: 預先計算的 template_vector（例如共享記憶體中的向量），None 的項目第一次評分時計算
+        """
+        self.regions = [tuple(r) for r in regions]
+        self.templates = templates
+        self.shapes = [t.shape for t in templates]
+        self.vectors = list(vectors) if vectors is not None else [None] * len(templates)
+        self._template_norms = None
+        self._layout_shape = None
+        self._layout = None
+
+    def _prepare(self):
+        """第一次評分時才轉換模板（只用於逐一比對的評分器不需要）"""
+        for i, tpl in enumerate(self.templates):
+            if self.vectors[i] is None:
+                self.vectors[i] = template_vector(tpl)
+        self._template_norms = np.array([norm for norm, _ in self.vectors])
+
+    def _build_layout(self, frame_shape):
+        """
+        依畫面尺寸決定可批次評分的區域與各區域在緩衝區中的位置（畫面尺寸不變時重複使用）
+        只記錄區域座標與位移，不建立逐像素的索引
+        """
+        if self._template_norms is None:
+            self._prepare()
+        height, width = frame_shape[:2]
+        channels = frame_shape[2] if len(frame_shape) == 3 else 1
+        batch = []  # 可批次評分的區域索引
+        fallback = []  # 尺寸不同，改用 match_region
+        slices = []  # (top, bottom, left, right, 緩衝區起點, 終點)
+        channel_starts = []
+        region_starts = []
+        offset = 0
+
+        for i, (left, top, right, bottom) in enumerate(self.regions):
+            l, t = max(0, left), max(0, top)
+            r, b = min(width, right), min(height, bottom)
+            shape = self.shapes[i]
+            tpl_channels = shape[2] if len(shape) == 3 else 1
+            if r <= l or b <= t:
+                batch_ok = False
+            else:
+                batch_ok = (b - t, r - l) == shape[:2] and tpl_channels == channels
+            if not batch_ok:
+                fallback.append(i)
+                continue
+
+            size = (b - t) * (r - l)
+            region_starts.append(offset)
+            slices.append((t, b, l, r, offset, offset + size * channels))
+            for c in range(channels):
+                channel_starts.append(offset)
+                offset += size
+            batch.append(i)
+
+        if batch:
+            # 連續區域切成不超過 GATHER_CHUNK 的段（單一區域超過時自成一段）
+            chunks, first = [], 0
+            ends = region_starts[1:] + [offset]
+            for k in range(len(batch)):
+                if k + 1 == len(batch) or ends[k + 1] - region_starts[first] > GATHER_CHUNK:
+                    chunks.append((first, k + 1, region_starts[first], ends[k]))
+                    first = k + 1
+            layout = {
+                "batch": np.array(batch),
+                "slices": slices,
+                "chunks": chunks,
+                "buffer_size": max(end - start for _, _, start, end in chunks),
+                "channel_starts": np.array(channel_starts),
+                "region_starts": np.array(region_starts),
+                "channel_sizes": np.diff(np.append(channel_starts, offset)),
+                "channels": channels,
+            }
+        else:
+            layout = {"batch": np.array([], dtype=int)}
+        layout["fallback"] = fallback
+        self._layout_shape = frame_shape
+        self._layout = layout
+        return layout
+
+    def score(self, frame):
+        """評分所有區域，返回與 regions 對應的分數陣列（區域超出畫面為 0）"""
+        layout = self._layout
+        if self._layout_shape != frame.shape:
+            layout = self._build_layout(frame.shape)
+
+        scores = np.zeros(len(self.regions))
+        batch = layout["batch"]
+        if len(batch):
+            # 各區域依通道優先順序複製到緩衝區，同時與模板向量做內積
+            channels = layout["channels"]
+            region_starts, channel_starts = layout["region_starts"], layout["channel_starts"]
+            numerator = np.empty(len(batch))
+            square_sum = np.empty(len(batch))
+            channel_sum = np.empty(len(channel_starts))
+            values = np.empty(layout["buffer_size"], dtype=np.float32)
+            for first, last, start, end in layout["chunks"]:
+                chunk = values[:end - start]
+                for k in range(first, last):
+                    t, b, l, r, lo, hi = layout["slices"][k]
+                    view = chunk[lo - start:hi - start]
+                    if frame.ndim == 3:
+                        view.reshape(frame.shape[2], b - t, r - l)[...] = np.moveaxis(frame[t:b, l:r], -1, 0)
+                    else:
+                        view.reshape(b - t, r - l)[...] = frame[t:b, l:r]
+                    numerator[k] = np.dot(view, self.vectors[batch[k]][1])
+                square_sum[first:last] = np.add.reduceat(
+                    np.square(chunk), region_starts[first:last] - start, dtype=np.float64)
+                channel_sum[first * channels:last * channels] = np.add.reduceat(
+                    chunk, channel_starts[first * channels:last * channels] - start, dtype=np.float64)
+            channel_mean_part = np.square(channel_sum) / layout["channel_sizes"]
+            mean_part = channel_mean_part.reshape(-1, layout["channels"]).sum(axis=1)
+            frame_norm = np.sqrt(np.maximum(square_sum - mean_part, 0))
+
+            # 與 OpenCV 相同的正規化邊界處理
+            abs_num = np.abs(numerator)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result = np.where(
+                    abs_num < frame_norm, numerator / frame_norm,
+                    np.where(abs_num < frame_norm * 1.125, np.sign(numerator), 0.0)
+                )
+            # 模板為單色時 OpenCV 回傳 1
+            flat_template = self._template_norms[batch] < np.finfo(np.float64).eps
+            result[flat_template] = 1.0
+            scores[batch] = result
+
+        for i in layout["fallback"]:
+            frame_region = core.crop_region(frame, self.regions[i])
+            scores[i] = core.match_region(frame_region, self.templates[i])
+        return scores
+
+
+def _to_gray(img):
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+
+def dhash(gray):
+    """差異雜湊：縮成 9x8 後比較左右相鄰像素，返回 64 位元整數"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+class HashIndex:
+    """
+    感知雜湊索引（多段索引）
+    - 同一位置的模板雜湊切成 max_distance + 1 段，各段建立「段值 -> 區域」表
+    - 漢明距離 <= max_distance 時至少有一段完全相同（鴿籠原理），查表後再驗證距離
+    - 每個區域位置每幀只計算一次雜湊，不需逐一檢查所有步驟
+    - 單色或低紋理模板的雜湊不穩定，一律列為候選
+    """
+    LOW_TEXTURE_STD = 3.0
+
+    def __init__(self, regions, templates, max_distance=10):
+        self.size = len(regions)
+        self.max_distance = max_distance
+        bands = min(max_distance + 1, 64)
+        self._bands = [(64 * b // bands, 64 * (b + 1) // bands) for b in range(bands)]
+        self._always = []
+        self._locations = {}  # (區域, 尺寸) -> ({區域索引: 雜湊}, [各段的表])
+
+        for i, (region, tpl) in enumerate(zip(regions, templates)):
+            gray = _to_gray(tpl)
+            if gray.size < 4 or gray.std() < self.LOW_TEXTURE_STD:
+                self._always.append(i)
+                continue
+            value = dhash(gray)
+            hashes, tables = self._locations.setdefault(
+                (tuple(region), gray.shape), ({}, [{} for _ in self._bands])
+            )
+            hashes[i] = value
+            for table, key in zip(tables, self._band_keys(value)):
+                table.setdefault(key, []).append(i)
+
+    def _band_keys(self, value):
+        return [(value >> (64 - hi)) & ((1 << (hi - lo)) - 1) for lo, hi in self._bands]
+
+    def candidates(self, frame):
+        """返回各區域是否可能匹配（bool 陣列）"""
+        result = np.zeros(self.size, dtype=bool)
+        result[self._always] = True
+        for (region, shape), (hashes, tables) in self._locations.items():
+            crop = core.crop_region(frame, region)
+            if crop is None or crop.shape[:2] != shape:
+                result[list(hashes)] = True  # 交給原尺寸比對處理
+                continue
+            value = dhash(_to_gray(crop))
+            found = set()
+            for table, key in zip(tables, self._band_keys(value)):
+                found.update(table.get(key, ()))
+            for i in found:
+                if bin(value ^ hashes[i]).count("1") <= self.max_distance:
+                    result[i] = True
+        return result
+
+
+# ============ 並行評分 ============
+
+_scoring_pool = None
+_scoring_pool_lock = threading.Lock()
+
+
+def scoring_pool():
+    """評分用線程池（所有比對計畫共用，大小為 CPU 核心數）"""
+    global _scoring_pool
+    with _scoring_pool_lock:
+        if _scoring_pool is None:
+            _scoring_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="scoring")
+        return _scoring_pool
+
+
+def _partition(coords, templates, parts):
+    """將區域依像素量切成 parts 段連續範圍，返回 [(start, end), ...]"""
+    sizes = np.cumsum([t.size for t in templates])
+    bounds = np.searchsorted(sizes, sizes[-1] * np.arange(1, parts) / parts, side="right")
+    edges = [0] + sorted(set(int(b) for b in bounds if 0 < b < len(coords))) + [len(coords)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+class MatchPlan:
+    """
+    編譯後的比對計畫：由 Profile 設定快照一次建立，網頁與 CLI 運行共用
+    - 預載各區域的模板裁切，座標與步驟屬性存成陣列
+    - 不同步驟的相同（區域, 模板裁切）以內容雜湊合併，每幀只評分一次
+    - first_match：依順序第一個通過閾值（網頁運行），預設順序為優先度高者優先
+    - best_match：優先度最高、其次分數最高者（CLI 運行）
+    - sequential_candidates：順序模式的可略過/可重複規則
+    """
+    __slots__ = (
+        "profile_name", "states", "threshold", "names", "orig_index", "clicks",
+        "skippable", "repeatable", "valid", "errors", "fullscreen", "template_shapes",
+        "region_coords", "state_starts", "watch_regions", "_crops", "_scorer", "_batch",
+        "_checked_shape", "_coarse_scale", "_coarse_margin", "_coarse_index", "_coarse_scorer",
+        "_stats", "_stat_mean_tolerance", "_stat_std_ratio", "_region_map", "shared_regions",
+        "_hash_index", "priority", "default_order", "_pool", "_partitions",
+        "check_every", "check_by_time", "_margins", "_windowed", "_windowed_states",
+        "_templates_checked_at",
+    )
+
+    def __init__(self, profile_name, states, threshold, allow_fullscreen=False, batch=True,
+                 coarse_scale=0, coarse_margin=0.15,
+                 prefilter=False, prefilter_mean=40, prefilter_std_ratio=2.5,
+                 hash_index=False, hash_distance=10, parallel=False, search_margin=0):
+        """
+        states: get_states_snapshot 的快照（只編譯啟用的步驟）
+        allow_fullscreen: 沒有區域的步驟以全畫面比對（CLI 行為）；否則視為錯誤
+        coarse_scale: 粗篩縮小倍數（0 為關閉），先以縮小灰階圖淘汰明顯不符的步驟
+        coarse_margin: 粗篩分數低於 threshold - coarse_margin 才淘汰
+        prefilter: 比對前先以區域平均/標準差淘汰明顯不符的步驟
+        prefilter_mean: 任一通道平均差超過此值即淘汰
+        prefilter_std_ratio: 標準差相差超過此倍數即淘汰
+        hash_index: 以感知雜湊索引找出候選步驟，只有候選步驟才評分
+        hash_distance: 雜湊漢明距離容許值
+        parallel: 同一幀的區域評分分散到 scoring_pool（numpy/OpenCV 運算會釋放 GIL），結果與逐一評分相同
+        search_margin: 區域搜尋範圍（像素），在區域四周 margin 內找最佳位置，容許介面偏移
+                       （狀態設定 search_margin 可個別覆寫，全畫面比對不適用）
+        """
+        self.profile_name = profile_name
+        self.states = states
+        self.threshold = threshold
+        self._batch = batch
+        self._coarse_scale = int(coarse_scale)
+        self._coarse_margin = coarse_margin
+        self._stat_mean_tolerance = prefilter_mean
+        self._stat_std_ratio = prefilter_std_ratio
+
+        names, orig_index, clicks, skippable, repeatable, priority = [], [], [], [], [], []
+        check_every, check_by_time = [], []
+        valid, fullscreen, template_shapes, crops_list = [], [], [], []
+        coords, templates, vectors, state_starts, margins = [], [], [], [0], []
+        self.errors = {}
+
+        for i, (name, config) in enumerate(states.items()):
+            if not config.get("enabled", True):
+                continue
+            names.append(name)
+            orig_index.append(i)
+            clicks.append(tuple(config.get("click", ())))
+            skippable.append(bool(config.get("skippable", False)))
+            repeatable.append(bool(config.get("repeatable", False)))
+            priority.append(int(config.get("priority", 0)))
+            every, unit = core.get_check_frequency(config)
+            check_every.append(float(every))
+            check_by_time.append(unit == "seconds")
+
+            regions = core.get_regions(config)
+            error = None
+            cached = None
+            if not regions and not allow_fullscreen:
+                error = "沒有設定區域"
+            else:
+                cached = core.template_cache.get(profile_name, name, regions)
+                if cached is None:
+                    error = "無法讀取模板"
+                elif any(c is None for c in cached[1]):
+                    bad = next(r for r, c in zip(regions, cached[1]) if c is None)
+                    error = f"區域 {list(bad)} 超出範圍"
+
+            crops_list.append(cached[1] if cached else None)
+            template_shapes.append(cached[0] if cached else None)
+            fullscreen.append(not regions)
+            if error:
+                self.errors[name] = error
+                valid.append(False)
+            else:
+                valid.append(True)
+                if regions:
+                    coords.extend(tuple(r) for r in regions)
+                    margins.extend([max(0, int(config.get("search_margin", search_margin)))] * len(regions))
+                else:
+                    h, w = cached[0]
+                    coords.append((0, 0, w, h))
+                    margins.append(0)
+                templates.extend(cached[1])
+                vectors.extend(get_template_vectors(profile_name, name, cached[1]) or [None] * len(cached[1]))
+            state_starts.append(len(coords))
+
+        self.names = tuple(names)
+        self.orig_index = np.array(orig_index, dtype=np.int32)
+        self.clicks = tuple(clicks)
+        self.skippable = np.array(skippable, dtype=bool)
+        self.repeatable = np.array(repeatable, dtype=bool)
+        self.priority = np.array(priority, dtype=np.int32)
+        # 優先度高者先比對，同優先度維持設定順序
+        self.default_order = [int(i) for i in np.argsort(-self.priority, kind="stable")]
+        self.check_every = np.array(check_every, dtype=np.float64)
+        self.check_by_time = np.array(check_by_time, dtype=bool)
+        self.valid = np.array(valid, dtype=bool)
+        self.fullscreen = tuple(fullscreen)
+        self.template_shapes = tuple(template_shapes)
+        self.region_coords = np.array(coords, dtype=np.int32).reshape(-1, 4)
+        self.state_starts = np.array(state_starts, dtype=np.int32)
+        self.watch_regions = list(dict.fromkeys(coords))
+        self._crops = crops_list
+
+        # 合併相同的（區域, 模板裁切）：_region_map 將各步驟的區域對應到不重複區域
+        unique_coords, unique_templates, unique_vectors, unique_margins, region_map, seen = [], [], [], [], [], {}
+        for region, tpl, vector, margin in zip(coords, templates, vectors, margins):
+            key = (region, margin, tpl.shape, hashlib.blake2b(tpl.tobytes(), digest_size=16).digest())
+            if key not in seen:
+                seen[key] = len(unique_coords)
+                unique_coords.append(region)
+                unique_templates.append(tpl)
+                unique_vectors.append(vector)
+                unique_margins.append(margin)
+            region_map.append(seen[key])
+        self._region_map = np.array(region_map, dtype=np.int32)
+        # 有搜尋範圍的區域不走批次評分結果，改以視窗搜尋
+        self._margins = np.array(unique_margins, dtype=np.int32)
+        self._windowed = [int(r) for r in np.flatnonzero(self._margins)]
+        # 有搜尋範圍的步驟（雜湊/統計/粗篩都以錄製位置判斷，不淘汰這些步驟）
+        self._windowed_states = np.zeros(len(names), dtype=bool)
+        if self._windowed:
+            region_windowed = self._margins[self._region_map] > 0
+            self._windowed_states[self.valid] = np.logical_or.reduceat(region_windowed, self.state_starts[:-1][self.valid])
+        self.shared_regions = len(coords) - len(unique_coords)
+        coords, templates = unique_coords, unique_templates
+
+        self._scorer = BatchScorer(coords, templates, unique_vectors) if coords else None
+        # 並行：批次評分切成數段連續區域，各段一個評分器
+        self._pool = scoring_pool() if parallel else None
+        self._partitions = None
+        if self._pool is not None and batch and len(coords) > 1:
+            self._partitions = [
+                (start, BatchScorer(coords[start:end], templates[start:end], unique_vectors[start:end]))
+                for start, end in _partition(coords, templates, self._pool._max_workers)
+            ]
+            if len(self._partitions) < 2:
+                self._partitions = None
+        self._checked_shape = None
+        self._templates_checked_at = time.monotonic()
+        self._coarse_index = None
+        self._coarse_scorer = None
+        if self._coarse_scale > 1 and coords:
+            self._build_coarse(coords, templates)
+        self._stats = self._build_stats(templates) if prefilter and coords else None
+        self._hash_index = HashIndex(coords, templates, hash_distance) if hash_index and coords else None
+
+    def __len__(self):
+        return len(self.names)
+
+    def state_regions(self, i):
+        """步驟的比對區域 [(left, top, right, bottom), ...]"""
+        return [tuple(int(v) for v in r) for r in self.region_coords[self.state_starts[i]:self.state_starts[i + 1]]]
+
+    def _build_coarse(self, coords, templates):
+        """
+        預先建立縮小灰階模板
+        區域內縮到縮小格線上，模板與畫面都以 scale x scale 區塊平均縮小，像素完全對齊
+        縮小後太小（< 2x2）的區域不做粗篩
+        """
+        scale = self._coarse_scale
+        index, coarse_coords, coarse_templates = [], [], []
+        for i, ((left, top, right, bottom), tpl) in enumerate(zip(coords, templates)):
+            cl, ct = -(-left // scale), -(-top // scale)
+            cr, cb = right // scale, bottom // scale
+            if cr - cl < 2 or cb - ct < 2 or tpl.shape[:2] != (bottom - top, right - left):
+                continue
+            gray = cv2.cvtColor(tpl, cv2.COLOR_BGR2GRAY) if tpl.ndim == 3 else tpl
+            inner = gray[ct * scale - top:cb * scale - top, cl * scale - left:cr * scale - left]
+            small = cv2.resize(inner, (cr - cl, cb - ct), interpolation=cv2.INTER_AREA)
+            index.append(i)
+            coarse_coords.append((cl, ct, cr, cb))
+            coarse_templates.append(small)
+        if index:
+            self._coarse_index = np.array(index)
+            self._coarse_scorer = BatchScorer(coarse_coords, coarse_templates)
+
+    @staticmethod
+    def _build_stats(templates):
+        """預先計算各區域模板的通道平均與整體標準差"""
+        means, stds = [], []
+        for tpl in templates:
+            mean, std = cv2.meanStdDev(tpl)
+            means.append(mean.ravel())
+            stds.append(float(np.sqrt(np.mean(np.square(std)))))
+        return means, np.array(stds)
+
+    def _stat_pass(self, frame, alive):
+        """
+        統計預篩：每個區域只算一次平均/標準差，返回各步驟是否可能通過
+        - 單色模板 OpenCV 一律給 1，不預篩
+        - 平均或標準差差太多的區域視為不可能匹配（近似判斷）
+        """
+        means, stds = self._stats
+        slack = 4.0  # 低紋理區域的雜訊容許
+        ratio = self._stat_std_ratio
+        regions = self._scorer.regions
+        region_pass = {}  # 不重複區域 -> 是否通過（共用區域只算一次）
+        passed = alive.copy()
+        for i in np.flatnonzero(alive):
+            for r in self._region_map[self.state_starts[i]:self.state_starts[i + 1]]:
+                ok = region_pass.get(r)
+                if ok is None:
+                    ok = True
+                    tpl_std = stds[r]
+                    crop = core.crop_region(frame, regions[r])
+                    # 單色模板、尺寸不符的區域交給原尺寸比對處理
+                    if tpl_std >= 1e-6 and crop is not None and crop.shape == self._scorer.shapes[r]:
+                        mean, std = cv2.meanStdDev(crop)
+                        frame_std = float(np.sqrt(np.mean(np.square(std))))
+                        ok = not (np.abs(mean.ravel() - means[r]).max() > self._stat_mean_tolerance
+                                  or frame_std > tpl_std * ratio + slack
+                                  or tpl_std > frame_std * ratio + slack)
+                    region_pass[r] = ok
+                if not ok:
+                    passed[i] = False
+                    break
+        return passed
+
+    def _coarse_region_scores(self, frame):
+        """粗篩各區域分數（不做粗篩的區域為 1）"""
+        scores = np.ones(len(self._scorer.regions))
+        if self._coarse_scorer is None:
+            return scores
+        scale = self._coarse_scale
+        height, width = frame.shape[:2]
+        h, w = height // scale, width // scale
+        if h == 0 or w == 0:
+            return scores
+        cropped = frame[:h * scale, :w * scale]
+        gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY) if cropped.ndim == 3 else cropped
+        small = cv2.resize(gray, (w, h), interpolation=cv2.INTER_AREA)
+        scores[self._coarse_index] = self._coarse_scorer.score(small)
+        return scores
+
+    def is_current(self, states):
+        """
+        快照與模板檔案都沒變更時返回 True
+        模板檔案（os.stat）與設定檔相同，最多每 ProfileConfigCache.CHECK_INTERVAL 秒檢查一次
+        """
+        if states is not self.states:
+            return False
+        now = time.monotonic()
+        if now - self._templates_checked_at < core.ProfileConfigCache.CHECK_INTERVAL:
+            return True
+        self._templates_checked_at = now
+        for i, name in enumerate(self.names):
+            regions = core.get_regions(self.states[name])
+            if not regions and not self.fullscreen[i]:
+                continue
+            cached = core.template_cache.get(self.profile_name, name, regions)
+            if (cached[1] if cached else None) is not self._crops[i]:
+                return False
+        return True
+
+    def frame_errors(self, frame):
+        """
+        檢查畫面尺寸與模板是否一致、區域是否超出畫面
+        同一尺寸只檢查一次，返回 [(步驟名稱, 訊息), ...]，已檢查過返回 []
+        """
+        if self._checked_shape == frame.shape:
+            return []
+        self._checked_shape = frame.shape
+        height, width = frame.shape[:2]
+        errors = []
+        for i, name in enumerate(self.names):
+            shape = self.template_shapes[i]
+            if not self.valid[i] or shape is None:
+                continue
+            if (height, width) != tuple(shape):
+                errors.append((name, f"尺寸不符 截圖={width}x{height} 模板={shape[1]}x{shape[0]}"))
+            for left, top, right, bottom in self.region_coords[self.state_starts[i]:self.state_starts[i + 1]]:
+                if min(width, right) <= max(0, left) or min(height, bottom) <= max(0, top):
+                    errors.append((name, f"區域 {[int(left), int(top), int(right), int(bottom)]} 超出範圍"))
+        return errors
+
+    def _window_search(self, frame, r):
+        """
+        在區域四周 margin 內搜尋模板
+        返回 (分數, (dx, dy))，dx/dy 為最佳位置相對錄製位置的偏移
+        """
+        left, top, right, bottom = self._scorer.regions[r]
+        template = self._scorer.templates[r]
+        margin = int(self._margins[r])
+        height, width = frame.shape[:2]
+        l, t = max(0, left - margin), max(0, top - margin)
+        window = frame[t:min(height, bottom + margin), l:min(width, right + margin)]
+        if window.shape[0] < template.shape[0] or window.shape[1] < template.shape[1]:
+            # 視窗比模板小（解析度不符等）：改用原位置比對
+            return core.match_region(core.crop_region(frame, self._scorer.regions[r]), template), (0, 0)
+        result = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, loc = cv2.minMaxLoc(result)
+        return score, (loc[0] + l - left, loc[1] + t - top)
+
+    def _region_score(self, frame, r):
+        """以原尺寸評分一個不重複區域（有搜尋範圍時取視窗內最高分）"""
+        if self._margins[r]:
+            return self._window_search(frame, r)[0]
+        return core.match_region(core.crop_region(frame, self._scorer.regions[r]), self._scorer.templates[r])
+
+    def _match_regions(self, frame, indices):
+        """逐一比對指定的不重複區域（parallel 時分散到線程池）"""
+        if self._pool is not None and len(indices) > 1:
+            return np.array(list(self._pool.map(lambda r: self._region_score(frame, r), indices)))
+        return np.array([self._region_score(frame, r) for r in indices])
+
+    def region_scores(self, frame):
+        """評分所有不重複區域"""
+        if self._scorer is None:
+            return np.zeros(0)
+        if not self._batch:
+            return self._match_regions(frame, range(len(self._scorer.regions)))
+        if self._partitions:
+            parts = self._pool.map(lambda part: part[1].score(frame), self._partitions)
+            scores = np.concatenate(list(parts))
+        else:
+            scores = self._scorer.score(frame)
+        if self._windowed:
+            scores[self._windowed] = self._match_regions(frame, self._windowed)
+        return scores
+
+    def score(self, frame):
+        """評分所有步驟（取各區域最低分），無效步驟為 0"""
+        if self._coarse_scorer is not None or self._stats is not None or self._hash_index is not None:
+            return self._staged_score(frame)
+        scores = np.zeros(len(self.names))
+        region_scores = self.region_scores(frame)
+        if len(region_scores):
+            starts = self.state_starts[:-1][self.valid]
+            scores[self.valid] = np.minimum.reduceat(region_scores[self._region_map], starts)
+        return scores
+
+    def _staged_score(self, frame):
+        """
+        分段淘汰 → 確認
+        - 雜湊索引：不在候選中的步驟分數為 0
+        - 統計預篩：淘汰的步驟分數為 0
+        - 粗篩：縮小灰階分數低於 threshold - coarse_margin 的步驟淘汰（分數記為粗篩分數）
+        - 剩下的步驟才以原尺寸彩色比對
+        各段都是近似判斷，容許值太嚴可能淘汰實際會匹配的步驟；有搜尋範圍的步驟不經淘汰
+        """
+        scores = np.zeros(len(self.names))
+        alive = self.valid.copy()
+        if self._hash_index is not None:
+            region_ok = self._hash_index.candidates(frame)[self._region_map]
+            starts = self.state_starts[:-1][self.valid]
+            alive[self.valid] = np.logical_and.reduceat(region_ok, starts)
+            alive |= self._windowed_states
+
+        if self._stats is not None and alive.any():
+            alive &= self._stat_pass(frame, alive) | self._windowed_states
+
+        if self._coarse_scorer is not None and alive.any():
+            coarse = np.zeros(len(self.names))
+            starts = self.state_starts[:-1][self.valid]
+            coarse_regions = self._coarse_region_scores(frame)[self._region_map]
+            coarse[self.valid] = np.minimum.reduceat(coarse_regions, starts)
+            rejected = alive & (coarse < self.threshold - self._coarse_margin) & ~self._windowed_states
+            scores[rejected] = coarse[rejected]
+            alive &= ~rejected
+
+        fine = np.full(len(self._scorer.regions), np.nan)  # 共用區域只比對一次
+        survivors = np.flatnonzero(alive)
+        needed = [int(r) for r in dict.fromkeys(
+            r for i in survivors for r in self._region_map[self.state_starts[i]:self.state_starts[i + 1]]
+        )]
+        if needed:
+            fine[needed] = self._match_regions(frame, needed)
+        for i in survivors:
+            scores[i] = fine[self._region_map[self.state_starts[i]:self.state_starts[i + 1]]].min()
+        return scores
+
+    def state_score(self, frame, i, memo=None):
+        """以原尺寸單獨評分一個步驟（memo: 不重複區域 -> 分數，同一幀內共用）"""
+        if memo is None:
+            memo = {}
+        score = None
+        for r in self._region_map[self.state_starts[i]:self.state_starts[i + 1]]:
+            value = memo.get(r)
+            if value is None:
+                value = memo[r] = self._region_score(frame, r)
+            score = value if score is None else min(score, value)
+        return score
+
+    def match_offset(self, frame, i):
+        """步驟在畫面中相對錄製位置的偏移 (dx, dy)（有搜尋範圍的區域偏移平均），沒有搜尋範圍為 (0, 0)"""
+        offsets = [
+            self._window_search(frame, r)[1]
+            for r in self._region_map[self.state_starts[i]:self.state_starts[i + 1]] if self._margins[r]
+        ]
+        if not offsets:
+            return 0, 0
+        return tuple(int(round(v)) for v in np.mean(offsets, axis=0))
+
+    def click_at(self, frame, i):
+        """步驟的點擊座標，依比對到的偏移修正；沒有點擊返回空 tuple"""
+        click = self.clicks[i]
+        if not click or not self._windowed:
+            return click
+        dx, dy = self.match_offset(frame, i)
+        return click[0] + dx, click[1] + dy
+
+    def first_match(self, frame, candidates=None, probe=0):
+        """
+        依 candidates 順序（預設 default_order）返回第一個通過閾值的步驟
+        probe: 先逐一評分前 probe 個候選，命中就不必評分其餘步驟
+               （候選依可能性排序時，多數畫面第一、二個就會命中）
+        返回 (在 candidates 中的位置, 步驟索引, 分數) 或 None
+        """
+        candidates = self.default_order if candidates is None else list(candidates)
+        memo = {}
+        for pos, i in enumerate(candidates[:probe]):
+            if self.valid[i]:
+                score = self.state_score(frame, i, memo)
+                if score >= self.threshold:
+                    return pos, i, float(score)
+
+        if len(candidates) <= probe:
+            return None
+        if (len(candidates) - probe) * 4 <= len(self):
+            # 候選很少（順序模式、依檢查頻率過濾後）：只評分候選步驟，不做整批評分
+            for pos, i in enumerate(candidates[probe:], probe):
+                if self.valid[i]:
+                    score = self.state_score(frame, i, memo)
+                    if score >= self.threshold:
+                        return pos, i, float(score)
+            return None
+        scores = self.score(frame)
+        for pos, i in enumerate(candidates[probe:], probe):
+            if self.valid[i] and scores[i] >= self.threshold:
+                return pos, i, float(scores[i])
+        return None
+
+    def best_match(self, frame):
+        """返回 (優先度最高、其次分數最高的步驟索引或 None, 分數, {步驟名稱: 分數})"""
+        scores = self.score(frame)
+        all_scores = {self.names[i]: float(scores[i]) for i in np.flatnonzero(self.valid)}
+        passed = self.valid & (scores >= self.threshold)
+        if not passed.any():
+            return None, 0, all_scores
+        top = passed & (self.priority == self.priority[passed].max())
+        best = int(np.argmax(np.where(top, scores, -np.inf)))
+        return best, float(scores[best]), all_scores
+
+    def sequential_candidates(self, current_index):
+        """
+        順序模式下要比對的步驟索引
+        - 如果當前步驟是可重複的，從當前步驟開始
+        - 否則從 current_index + 1 開始
+        - 到下一個不可略過的步驟為止
+        """
+        start_idx = current_index + 1
+        current_is_repeatable = False
+
+        # 如果當前步驟是可重複的，從當前步驟開始比對
+        if 0 <= current_index < len(self.names) and self.repeatable[current_index]:
+            start_idx = current_index
+            current_is_repeatable = True
+
+        candidates = []
+        for idx in range(start_idx, len(self.names)):
+            candidates.append(idx)
+            # 遇到不可略過的步驟就停止
+            # 但當前的 repeatable 步驟不算停止點（需要繼續往後找）
+            if not self.skippable[idx]:
+                if current_is_repeatable and idx == current_index:
+                    continue
+                break
+        return candidates
+
+
+class MatchBudget:
+    """
+    每幀比對時間預算（步驟很多、一次全部比對超過截圖間隔時使用）
+    - 依候選順序逐一評分，第一個通過閾值的步驟即返回；預算足夠時結果與 first_match 相同
+    - 預算用完時，尚未評分的步驟延到下一幀優先評分（輪流），不會永遠輪不到
+    - 優先度 > 0 的步驟每幀都評分，不受預算限制
+    - scored 記錄這一幀實際評分過的步驟；預算用完時未匹配不代表畫面中沒有匹配的步驟
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.carry = []  # 上一幀延後的步驟索引
+        self.scored = []  # 這一幀評分過的步驟索引
+        self._plan = None
+
+    def first_match(self, plan, frame, candidates=None):
+        """同 MatchPlan.first_match，返回 (在 candidates 中的位置, 步驟索引, 分數) 或 None"""
+        if plan is not self._plan:
+            self._plan = plan
+            self.carry = []
+        candidates = plan.default_order if candidates is None else list(candidates)
+        position = {i: pos for pos, i in enumerate(candidates)}
+        urgent = [i for i in candidates if plan.priority[i] > 0]
+        # 延後的步驟維持上一幀留下的順序，下一輪接著評分
+        carried = [i for i in self.carry if i in position and plan.priority[i] <= 0]
+        carried_set = set(carried)
+        order = urgent + carried + [i for i in candidates if plan.priority[i] <= 0 and i not in carried_set]
+
+        deadline = time.perf_counter() + self.budget
+        memo = {}
+        for n, i in enumerate(order):
+            # 每幀至少評分一個一般步驟，輪流才會前進
+            if n > len(urgent) and time.perf_counter() >= deadline:
+                self.carry = order[n:]
+                self.scored = order[:n]
+                return None
+            if not plan.valid[i]:
+                continue
+            score = plan.state_score(frame, i, memo)
+            if score >= plan.threshold:
+                # 還沒輪到的延後步驟保留到下一幀
+                self.carry = [j for j in order[n + 1:] if j in carried_set]
+                self.scored = order[:n + 1]
+                return position[i], i, float(score)
+        self.carry = []
+        self.scored = order
+        return None
+
+
+class CheckSchedule:
+    """
+    步驟檢查頻率（狀態設定 check_every / check_unit）
+    - frames: 每 N 幀比對一次；seconds: 距上次比對滿 N 秒才再比對
+    - 未設定的步驟每幀比對；以步驟名稱記錄，重新編譯計畫後仍延續
+    - 實際評分過（checked）才算比對過；輪到但沒評分的步驟下一幀仍會比對
+    """
+    def __init__(self):
+        self.frame = 0
+        self._last = {}  # 步驟名稱 -> (幀數, 時間)
+
+    def due(self, plan, candidates=None):
+        """過濾出這一幀要比對的候選步驟"""
+        candidates = plan.default_order if candidates is None else candidates
+        self.frame += 1
+        now = time.monotonic()
+        result = []
+        for i in candidates:
+            every = plan.check_every[i]
+            if every != 1 or plan.check_by_time[i]:
+                last = self._last.get(plan.names[i])
+                if last is not None:
+                    if plan.check_by_time[i] and now - last[1] < every:
+                        continue
+                    if not plan.check_by_time[i] and self.frame - last[0] < every:
+                        continue
+            result.append(i)
+        return result
+
+    def checked(self, plan, indices):
+        """記錄這一幀實際評分過的步驟"""
+        now = time.monotonic()
+        for i in indices:
+            if plan.check_every[i] != 1 or plan.check_by_time[i]:
+                self._last[plan.names[i]] = (self.frame, now)
+
+
+def build_plan(profile_name, states, settings, allow_fullscreen=False):
+    """依共用設定編譯比對計畫"""
+    coarse_scale = settings.get("coarse_scale", 4) if settings.get("coarse_to_fine") else 0
+    return MatchPlan(
+        profile_name, states, settings["match_threshold"],
+        allow_fullscreen=allow_fullscreen,
+        batch=settings.get("batch_scoring", True),
+        coarse_scale=coarse_scale,
+        coarse_margin=settings.get("coarse_margin", 0.15),
+        prefilter=settings.get("stat_prefilter", False),
+        prefilter_mean=settings.get("stat_mean_tolerance", 40),
+        prefilter_std_ratio=settings.get("stat_std_ratio", 2.5),
+        hash_index=settings.get("hash_index", False),
+        hash_distance=settings.get("hash_distance", 10),
+        parallel=settings.get("parallel_scoring", False),
+        search_margin=settings.get("search_margin", 0),
+    )
@@ -11,6 +11,7 @@ from multiprocessing import Process, Event
 
 import cv2
 import core
+import shm
 
 
 def clear_screen():
@@ -238,11 +239,21 @@ def run_multiple_profiles(profiles):
     processes = []
     stop_events = []
 
+    # 模板與畫面放在共享記憶體，各行程不再各自載入與截圖
+    try:
+        session = shm.SharedSession(selected, core.get_shared_settings())
+    except (OSError, ValueError) as e:
+        print(f"無法建立共享記憶體，各行程獨立載入: {e}")
+        session = None
+    if session:
+        print(f"共享模板: {session.templates.nbytes / 1024 / 1024:.1f} MB"
+              f"{'，共享畫面' if session.frames else ''}\n")
+
     try:
         for name in selected:
             stop_event = Event()
             stop_events.append(stop_event)
-            p = Process(target=core.run_automation, args=(name, stop_event))
+            p = Process(target=core.run_automation, args=(name, stop_event, session.handle if session else None))
             p.start()
             processes.append(p)
             print(f"啟動: {name} (PID: {p.pid})")
@@ -257,6 +268,9 @@ def run_multiple_profiles(profiles):
         for p in processes:
             p.terminate()
             p.join(timeout=2)
+    finally:
+        if session:
+            session.close()
 
     input("\n按 Enter 返回...")
 
@@ -0,0 +1,218 @@
+"""
+共享記憶體：併行運行（run.py）時各行程共用模板與畫面
+- 模板：主行程解碼一次放進共享記憶體，各行程直接引用，不複製也不 pickle
+  批次評分用的 float32 模板向量（matcher.template_vector）也由主行程計算一次後共享
+- 畫面：主行程截圖寫入共享緩衝區，同時要求的行程合併為一次截圖
+"""
+
+import threading
+import time
+from multiprocessing import Condition, Value, shared_memory
+
+import numpy as np
+
+import core
+import matcher
+
+ALIGN = 64  # 各裁切在共享記憶體中的對齊（位元組）
+
+
+# ============ 模板共享 ============
+
+class SharedTemplateStore:
+    """
+    模板共享：所有 Profile 的模板裁切與模板向量放在同一塊共享記憶體
+    handle 為可傳給子行程的描述（共享記憶體名稱與各裁切、向量的位置）
+    """
+    def __init__(self, profiles):
+        entries = []
+        total = 0
+
+        def allocate(nbytes):
+            nonlocal total
+            offset = total
+            total += -(-nbytes // ALIGN) * ALIGN
+            return offset
+
+        for profile_name in profiles:
+            states = core.get_states_snapshot(profile_name)
+            for state_name, config in states.items():
+                if config.get("enabled", True):
+                    core.template_cache.get(profile_name, state_name, core.get_regions(config))
+            for state_name, stamp, regions, (shape, crops) in core.template_cache.entries(profile_name):
+                layout = []
+                for crop in crops:
+                    if crop is None:
+                        layout.append(None)
+                        continue
+                    # 向量與裁切元素數相同（float32）
+                    layout.append((allocate(crop.nbytes), crop.shape, allocate(crop.size * 4)))
+                entries.append((profile_name, state_name, stamp, regions, shape, layout, crops))
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(total, 1))
+        handle_entries = []
+        for *entry, layout, crops in entries:
+            positions = []
+            for position, crop in zip(layout, crops):
+                if position is None:
+                    positions.append(None)
+                    continue
+                offset, shape, vector_offset = position
+                np.ndarray(crop.shape, np.uint8, self.shm.buf, offset)[...] = crop
+                norm, vector = matcher.template_vector(crop)
+                np.ndarray(vector.shape, np.float32, self.shm.buf, vector_offset)[...] = vector
+                positions.append((offset, shape, vector_offset, norm))
+            handle_entries.append(tuple(entry) + (positions,))
+        self.handle = (self.shm.name, handle_entries)
+        self.nbytes = total
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+_attached = []  # 子行程持有的共享記憶體（模板引用期間不可關閉）
+
+
+def attach_templates(handle):
+    """
+    子行程：以共享記憶體中的模板填入 core.template_cache，模板向量登記到 matcher
+    返回引用的模板數
+    """
+    name, entries = handle
+    shm = shared_memory.SharedMemory(name=name)
+    _attached.append(shm)
+    for profile_name, state_name, stamp, regions, shape, layout in entries:
+        crops, vectors = [], []
+        for position in layout:
+            if position is None:
+                crops.append(None)
+                vectors.append(None)
+                continue
+            offset, crop_shape, vector_offset, norm = position
+            crop = np.ndarray(crop_shape, np.uint8, shm.buf, offset)
+            crop.flags.writeable = False
+            vector = np.ndarray((crop.size,), np.float32, shm.buf, vector_offset)
+            vector.flags.writeable = False
+            crops.append(crop)
+            vectors.append((norm, vector))
+        core.template_cache.put(profile_name, state_name, stamp, regions, (shape, crops))
+        matcher.put_template_vectors(profile_name, state_name, crops, vectors)
+    return len(entries)
+
+
+# ============ 畫面共享 ============
+
+class FrameBroadcaster:
+    """
+    主行程：背景線程依子行程要求截圖，寫入共享緩衝區
+    在擷取中收到的要求會再截一次，確保子行程拿到要求之後的畫面
+    """
+    def __init__(self, source, shape):
+        self.source = source
+        self.shape = tuple(shape)
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self._frame = np.ndarray(self.shape, np.uint8, self.shm.buf)
+        self.cond = Condition()
+        self.attempts = Value("Q", 0, lock=False)  # 已完成的截圖次數（含失敗）
+        self.ok = Value("b", 0, lock=False)  # 最近一次截圖是否成功
+        self.requested = Value("b", 0, lock=False)
+        self.capturing = Value("b", 0, lock=False)
+        self.closed = Value("b", 0, lock=False)
+        self.handle = (self.shm.name, self.shape, self.cond, self.attempts, self.ok,
+                       self.requested, self.capturing, self.closed)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.requested.value and not self.closed.value:
+                    self.cond.wait(0.5)
+                if self.closed.value:
+                    return
+                self.requested.value = 0
+                self.capturing.value = 1
+
+            frame = self.source.grab()
+
+            with self.cond:
+                self.capturing.value = 0
+                ok = frame is not None and frame.shape == self.shape
+                if ok:
+                    np.copyto(self._frame, frame)
+                elif frame is not None:
+                    core.adb_log(f"FrameBroadcaster: 畫面尺寸改變 {frame.shape}，無法共享")
+                self.ok.value = int(ok)
+                self.attempts.value += 1
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed.value = 1
+            self.cond.notify_all()
+        self._thread.join(timeout=5)
+        self.source.close()
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedFrameSource:
+    """子行程：從主行程的共享緩衝區取得畫面（介面同 capture.ScreenshotSource）"""
+    executor = None
+    TIMEOUT = 10.0
+
+    def __init__(self, handle):
+        name, shape, self._cond, self._attempts, self._ok, self._requested, self._capturing, self._closed = handle
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._frame = np.ndarray(shape, np.uint8, self._shm.buf)
+
+    def grab(self):
+        """要求主行程截圖並複製結果，失敗返回 None"""
+        deadline = time.monotonic() + self.TIMEOUT
+        with self._cond:
+            # 擷取中的畫面可能早於要求，需等下一次
+            target = self._attempts.value + (2 if self._capturing.value else 1)
+            self._requested.value = 1
+            self._cond.notify_all()
+            while self._attempts.value < target and not self._closed.value:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            if self._closed.value or not self._ok.value:
+                return None
+            return self._frame.copy()
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        self._frame = None
+        self._shm.close()
+
+
+# ============ 併行運行 ============
+
+class SharedSession:
+    """併行運行的共享資源；handle 傳給 core.run_automation"""
+    def __init__(self, profiles, settings, device="localhost:5555"):
+        import capture
+        self.templates = SharedTemplateStore(profiles)
+        self.frames = None
+        if core.adb_connect():
+            source = capture.open_frame_source(device, settings)
+            first_frame = source.grab()
+            if first_frame is not None:
+                self.frames = FrameBroadcaster(source, first_frame.shape)
+            else:
+                source.close()
+        self.handle = {
+            "templates": self.templates.handle,
+            "frames": self.frames.handle if self.frames else None,
+        }
+
+    def close(self):
+        if self.frames:
+            self.frames.close()
+        self.templates.close()
@@ -6,24 +6,26 @@
 function deviceBar() {
     return {
         devices: [],
+        running: {},  // 設備 -> 運行中的腳本名稱
         selected: '',
         status: '',
         statusClass: '',
         loading: true,
 
         async init() {
-            await this.refresh();
+            await this.refresh(false);
         },
 
-        async refresh() {
+        async refresh(rescan = true) {
             this.loading = true;
             this.status = '';
             this.statusClass = '';
 
             try {
-                const res = await fetch('/api/devices');
+                const res = await fetch(rescan ? '/api/devices?rescan=1' : '/api/devices');
                 const data = await res.json();
                 this.devices = data.devices || [];
+                await this.refreshRunning();
 
                 if (this.devices.length === 0) {
                     this.status = '請開啟模擬器';
@@ -48,9 +50,31 @@ function deviceBar() {
             this.loading = false;
         },
 
+        async refreshRunning() {
+            try {
+                const res = await fetch('/api/runners');
+                const data = await res.json();
+                this.running = {};
+                for (const r of data.runners || []) {
+                    if (r.status === 'running') this.running[r.device] = r.profile;
+                }
+            } catch (e) {
+                this.running = {};
+            }
+        },
+
+        label(d) {
+            const profile = this.running[d.id];
+            return profile ? `${d.name}（運行中: ${profile}）` : d.name;
+        },
+
         save() {
             if (this.selected) {
+                const changed = localStorage.getItem('selectedDevice') !== this.selected;
                 localStorage.setItem('selectedDevice', this.selected);
+                if (changed) {
+                    window.dispatchEvent(new CustomEvent('device-changed', { detail: this.selected }));
+                }
             }
         },
 
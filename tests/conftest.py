@@ -0,0 +1,39 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import core  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def adb_log_path(tmp_path, monkeypatch):
+    """ADB 除錯日誌寫到暫存目錄"""
+    monkeypatch.setattr(core, "ADB_LOG_PATH", tmp_path / "adb.log")
+
+
+@pytest.fixture
+def profiles_dir(tmp_path, monkeypatch):
+    """Profile 放在暫存目錄，不動到實際資料"""
+    monkeypatch.setattr(core, "PROFILES_DIR", tmp_path)
+    core.profile_config_cache.invalidate()
+    core.template_cache.invalidate()
+    yield tmp_path
+    core.profile_config_cache.invalidate()
+    core.template_cache.invalidate()
+
+
+@pytest.fixture
+def settings():
+    """測試用設定：不等待、不學習轉移、固定輪詢"""
+    settings = dict(core.DEFAULT_SETTINGS)
+    settings.update(click_delay=[0, 0], learn_transitions=False, adaptive_polling=False,
+                    skip_static_frames=True)
+    return settings
+
+
+def random_image(seed, shape=(200, 100, 3)):
+    return (np.random.default_rng(seed).random(shape) * 255).astype(np.uint8)
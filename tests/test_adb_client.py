@@ -0,0 +1,59 @@
+"""持久 shell 連線池（以 socketpair 模擬設備端）"""
+
+import socket
+import threading
+import time
+
+import pytest
+
+import adb_client
+
+
+class FakeClient:
+    """open_shell 返回 socketpair 的一端，另一端交給測試模擬設備"""
+    def __init__(self, delay=None):
+        self.devices = []
+        self.delay = delay or {}
+
+    def open_shell(self, serial):
+        time.sleep(self.delay.get(serial, 0))
+        ours, theirs = socket.socketpair()
+        ours.settimeout(0.2)
+        self.devices.append(theirs)
+        return adb_client.ShellSession(ours)
+
+
+def reply(device, output, code=0):
+    device.recv(65536)
+    device.sendall(output + b"__SBSS_END__ %d\n" % code)
+
+
+def test_stale_session_is_reopened_once():
+    client = FakeClient()
+    pool = adb_client.AdbConnectionPool(client)
+    pool._session("a")
+    client.devices[0].close()
+    pool._sessions["a"].sock.shutdown(socket.SHUT_WR)  # 送出失敗
+    threading.Thread(target=lambda: (time.sleep(0.05), reply(client.devices[1], b"ok\n"))).start()
+    assert pool.shell("a", "input tap 1 2") == (0, "ok\n")
+    assert len(client.devices) == 2
+
+
+def test_read_timeout_is_not_retried():
+    """指令已送出後逾時：不重送（點擊不會執行兩次）"""
+    client = FakeClient()
+    pool = adb_client.AdbConnectionPool(client)
+    with pytest.raises(adb_client.AdbCommandSentError):
+        pool.shell("a", "input tap 1 2")
+    assert len(client.devices) == 1
+    assert b"input tap 1 2" in client.devices[0].recv(65536)
+
+
+def test_slow_device_does_not_block_others():
+    client = FakeClient(delay={"slow": 0.5})
+    pool = adb_client.AdbConnectionPool(client)
+    threading.Thread(target=pool._session, args=("slow",), daemon=True).start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    pool._session("fast")
+    assert time.monotonic() - started < 0.2
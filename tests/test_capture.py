@@ -0,0 +1,78 @@
+"""畫面來源與管線化預取"""
+
+import struct
+import time
+
+import cv2
+import numpy as np
+
+import capture
+import core
+
+
+class SlowSource:
+    """每次擷取耗時 capture_time 秒，記錄各幀開始擷取的時間"""
+    def __init__(self, capture_time=0.2):
+        self.capture_time = capture_time
+        self.started = []
+
+    def grab(self):
+        self.started.append(time.monotonic())
+        time.sleep(self.capture_time)
+        return np.full((4, 4, 3), len(self.started), dtype=np.uint8)
+
+    def close(self):
+        pass
+
+
+def test_pipeline_only_when_requested(settings):
+    """pipeline 設定只對傳入 pipeline=True 的呼叫端（網頁 Runner）生效"""
+    settings.update(pipeline=True, capture_source="screenshot")
+    assert isinstance(capture.open_frame_source("x", settings), capture.ScreenshotSource)
+    source = capture.open_frame_source("x", settings, pipeline=True)
+    try:
+        assert isinstance(source, capture.FramePrefetcher)
+    finally:
+        source.close()
+
+
+def test_tap_during_prefetch_discards_frame():
+    """預取進行中送出點擊：點擊前開始擷取的幀被丟棄，返回點擊後才擷取的畫面"""
+    raw = SlowSource()
+    source = capture.FramePrefetcher(raw, capture.ActionExecutor(), interval=0.05)
+    taps = []
+    try:
+        source.grab()
+        # 等下一幀開始預取後再點擊
+        deadline = time.monotonic() + 2
+        while len(raw.started) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(raw.started) == 2
+        source.executor.submit(lambda: taps.append(time.monotonic()), delay=0.1)
+        frame = source.grab()
+        assert taps
+        assert frame[0, 0, 0] == len(raw.started)
+        assert raw.started[-1] >= taps[0]
+    finally:
+        source.close()
+
+
+def test_unsupported_raw_format_falls_back_to_png_once(monkeypatch):
+    """原始格式不支援（RGB_565）：第一次後直接用 PNG，不再每幀多拉一次原始緩衝區"""
+    png = cv2.imencode(".png", np.zeros((4, 2, 3), dtype=np.uint8))[1].tobytes()
+    rgb565 = struct.pack("<IIII", 2, 4, 4, 0) + bytes(2 * 4 * 2)
+    calls = []
+
+    def exec_out(device, cmd):
+        calls.append(cmd)
+        return png if cmd == "screencap -p" else rgb565
+
+    monkeypatch.setattr(core, "adb_exec_out", exec_out)
+    monkeypatch.setattr(core, "_raw_unsupported", set())
+    for _ in range(3):
+        assert core.adb_screenshot("rgb565", mode="raw").shape == (4, 2, 3)
+    assert calls == ["screencap", "screencap -p", "screencap -p", "screencap -p"]
+    # 沒收到資料不算不支援
+    monkeypatch.setattr(core, "adb_exec_out", lambda device, cmd: None)
+    core.adb_screenshot("offline", mode="raw")
+    assert core.raw_capture_supported("offline")
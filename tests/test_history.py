@@ -0,0 +1,24 @@
+"""狀態轉移統計"""
+
+import core
+import history
+
+
+def test_runners_on_same_profile_share_history(profiles_dir):
+    """同一 Profile 在多個設備運行：共用一份統計，寫入時不互相覆蓋"""
+    core.create_profile("p")
+    first = history.open_history("p")
+    second = history.open_history("p")
+    assert first is second
+    first.record(None, "a", 1.0)
+    second.record("a", "b", 2.0)
+    history.close_history(first)
+    second.record("b", "a", 0.5)
+    history.close_history(second)
+
+    saved = history.TransitionHistory("p")
+    assert saved.counts(None) == {"a": 1}
+    assert saved.counts("a") == {"b": 1}
+    assert saved.counts("b") == {"a": 1}
+    # 全部釋放後下次重新讀取檔案
+    assert history.open_history("p") is not first
@@ -0,0 +1,111 @@
+"""網頁 Runner 比對循環（假畫面來源，不需要 ADB）"""
+
+import core
+import web
+
+from conftest import random_image
+
+
+class FakeSource:
+    """依序返回畫面，用完後停止 Runner"""
+    executor = None
+
+    def __init__(self, runner, frames):
+        self.runner = runner
+        self.frames = list(frames)
+        self.grabs = 0
+        self.waits = []
+
+    def grab(self):
+        if self.grabs >= len(self.frames):
+            self.runner.status = "stopped"
+            return self.frames[-1]
+        self.grabs += 1
+        return self.frames[self.grabs - 1]
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+
+    def close(self):
+        pass
+
+
+def make_runner(profile_name, monkeypatch):
+    taps = []
+    monkeypatch.setattr(core, "adb_tap", lambda x, y, device=None, mode=None, screen=None: taps.append((x, y)))
+    runner = web.Runner("test")
+    runner.profile_name = profile_name
+    runner.status = "running"
+    runner.check_schedule = web.matcher.CheckSchedule()
+    return runner, taps
+
+
+def popup_profile(check_every=1):
+    """背景上出現的彈窗（popup）與一個不會出現的步驟（other）"""
+    popup = random_image(1)
+    core.create_profile("p")
+    core.imwrite_safe(core.get_template_path("popup", "p"), popup)
+    core.imwrite_safe(core.get_template_path("other", "p"), random_image(2))
+    core.add_state("p", "popup", [30, 30], [[20, 20, 60, 60]])
+    core.add_state("p", "other", [5, 5], [[0, 100, 40, 140]])
+    config = core.get_profile_config("p")
+    core.set_check_frequency(config["states"]["popup"], check_every, "frames")
+    core.save_profile_config("p", config)
+    background = 255 - popup
+    shown = background.copy()
+    shown[20:60, 20:60] = popup[20:60, 20:60]
+    return background, shown
+
+
+def test_popup_on_static_screen_is_tapped(profiles_dir, settings, monkeypatch):
+    """檢查頻率較低的彈窗出現後畫面不再變化，仍會在輪到時比對並點擊"""
+    background, shown = popup_profile(check_every=3)
+    runner, taps = make_runner("p", monkeypatch)
+    runner._loop(FakeSource(runner, [background] + [shown] * 20), settings)
+    assert taps and taps[0] == (30, 30)
+
+
+def test_static_miss_is_reused(profiles_dir, settings, monkeypatch):
+    """所有步驟都比對過的未匹配，畫面不變時不重新比對"""
+    background, _ = popup_profile()
+    runner, taps = make_runner("p", monkeypatch)
+    calls = []
+    decide = runner._decide
+    monkeypatch.setattr(runner, "_decide", lambda *args: calls.append(1) or decide(*args))
+    runner._loop(FakeSource(runner, [background] * 5), settings)
+    assert not taps and len(calls) == 1
+
+
+def test_budget_carry_over_on_static_screen(profiles_dir, settings, monkeypatch):
+    """預算用完時延後的步驟在畫面不變時仍會輪到（彈窗持續出現就持續點擊）"""
+    background, shown = popup_profile()
+    config = core.get_profile_config("p")
+    config["states"] = {"other": config["states"]["other"], "popup": config["states"]["popup"]}
+    core.save_profile_config("p", config)
+    settings["match_budget"] = 1e-9  # 每幀只評分一個步驟
+    runner, taps = make_runner("p", monkeypatch)
+    runner._loop(FakeSource(runner, [background] + [shown] * 10), settings)
+    assert len(taps) >= 4
+
+
+def test_match_resets_miss_count_with_wait_for_change(profiles_dir, settings, monkeypatch):
+    """點擊後直接比對變化畫面時，未匹配次數仍從 0 重新計算"""
+    background, shown = popup_profile()
+    settings.update(wait_for_change=True, skip_static_frames=False, miss_threshold=3)
+    monkeypatch.setattr(web.capture, "wait_for_change", lambda source, frame, *args, **kwargs: background)
+    runner, taps = make_runner("p", monkeypatch)
+    source = FakeSource(runner, [background, background, shown, background, background])
+    runner._loop(source, settings)
+    assert len(taps) == 1
+    assert source.waits[:4] == [settings["loop_interval"]] * 4
+
+
+def test_status_queries_do_not_create_runners(monkeypatch):
+    manager = web.RunnerManager()
+    monkeypatch.setattr(web, "runners", manager)
+    client = web.app.test_client()
+    for i in range(5):
+        data = client.get(f"/api/runner/status?device=unknown:{i}").get_json()
+        assert data["status"] == "stopped" and data["device"] == f"unknown:{i}"
+    assert client.post("/api/runner/stop", json={"device": "unknown:9"}).get_json() == {"success": False}
+    assert manager.statuses() == []
@@ -0,0 +1,66 @@
+"""觸控輸入通道的座標換算"""
+
+import touch
+
+AXES = {"ABS_MT_POSITION_X": (0, 1079), "ABS_MT_POSITION_Y": (0, 1919), "ABS_MT_SLOT": (0, 9)}
+
+
+def test_raw_follows_display_rotation():
+    """觸控座標對應自然方向（直向 1080x1920），橫向畫面的座標先換回自然方向"""
+    device = touch.TouchDevice("/dev/input/event1", AXES, True, 1080, 1920)
+    assert device.raw(100, 200) == (100, 200)
+    # 90°：畫面左上角對應自然方向的右上角
+    assert device.raw(0, 0, 1) == (1079, 0)
+    assert device.raw(1919, 1079, 1) == (0, 1919)
+    assert device.raw(0, 0, 2) == (1079, 1919)
+    assert device.raw(0, 0, 3) == (0, 1919)
+
+
+def test_parse_rotation():
+    assert touch.parse_rotation("    SurfaceOrientation: 1\n") == 1
+    assert touch.parse_rotation("  Viewport INTERNAL: displayId=0, uniqueId=local:0, orientation=3, "
+                                "logicalFrame=[0, 0, 1920, 1080]\n") == 3
+    assert touch.parse_rotation("") is None
+
+
+def test_unknown_rotation_falls_back_to_input(monkeypatch):
+    channel = touch.InputChannel("test", "sendevent")
+    channel._prepared = True
+    channel.touch = touch.TouchDevice("/dev/input/event1", AXES, True, 1080, 1920)
+    monkeypatch.setattr(touch.core, "adb_shell", lambda cmd, device: (0, ""))
+    assert channel.script([("tap", 5, 6)]) == "input tap 5 6"
+
+
+def test_rotation_read_only_when_screen_shape_changes(monkeypatch):
+    """回報畫面尺寸後，只有尺寸改變才重新讀取螢幕方向"""
+    reads = []
+    rotation = {"value": "SurfaceOrientation: 0"}
+
+    def shell(cmd, device):
+        reads.append(cmd)
+        return 0, rotation["value"]
+
+    channel = touch.InputChannel("test", "sendevent")
+    channel._prepared = True
+    channel.touch = touch.TouchDevice("/dev/input/event1", AXES, True, 1080, 1920)
+    monkeypatch.setattr(touch.core, "adb_shell", shell)
+    monkeypatch.setattr(touch, "ROTATION_TTL", 0)
+    channel.observe((1920, 1080, 3))
+    for _ in range(3):
+        channel.script([("tap", 5, 6)])
+    assert len(reads) == 1
+    rotation["value"] = "SurfaceOrientation: 1"
+    channel.observe((1080, 1920, 3))
+    assert " 53 1079" in channel.script([("tap", 0, 0)])
+    channel.script([("tap", 0, 0)])
+    assert len(reads) == 2
+
+
+def test_unrotated_screen_without_dumpsys(monkeypatch):
+    """讀不到方向但畫面尺寸與自然方向相同：視為未旋轉，仍用 sendevent"""
+    channel = touch.InputChannel("test", "sendevent")
+    channel._prepared = True
+    channel.touch = touch.TouchDevice("/dev/input/event1", AXES, True, 1080, 1920)
+    monkeypatch.setattr(touch.core, "adb_shell", lambda cmd, device: (0, ""))
+    channel.observe((1920, 1080, 3))
+    assert channel.script([("tap", 5, 6)]).startswith("sendevent")
@@ -0,0 +1,267 @@
+"""
+觸控輸入通道：每個設備一個，手勢組成一段 shell 指令，一次往返送出
+- input: Android input 指令（每個手勢都會啟動一次 app_process，約 300ms）
+- sendevent: 直接寫入觸控螢幕的 input 事件，不啟動 JVM，點擊只需數毫秒
+  找不到可寫入的觸控裝置、或讀不到螢幕方向時自動改用 input
+"""
+
+import re
+import threading
+import time
+
+import core
+
+# 事件代碼（linux/input-event-codes.h）
+EV_SYN, EV_KEY, EV_ABS = 0, 1, 3
+SYN_REPORT, SYN_MT_REPORT = 0, 2
+BTN_TOUCH = 330
+ABS_MT_SLOT, ABS_MT_TOUCH_MAJOR = 47, 48
+ABS_MT_POSITION_X, ABS_MT_POSITION_Y = 53, 54
+ABS_MT_TRACKING_ID, ABS_MT_PRESSURE = 57, 58
+
+SWIPE_STEP = 0.016  # 滑動時每個移動事件的間隔（秒）
+MAX_SWIPE_STEPS = 60
+ROTATION_TTL = 2.0  # 呼叫端沒有回報畫面尺寸時，螢幕方向的重新讀取間隔（秒）
+
+_AXIS_RE = re.compile(r"(ABS_MT_\w+)\s*:\s*value -?\d+, min (-?\d+), max (-?\d+)")
+# 舊版 dumpsys input 有 SurfaceOrientation，新版只有 Viewport 的 orientation
+_ROTATION_RE = re.compile(r"SurfaceOrientation:\s*(\d)|Viewport INTERNAL:.*?orientation=(\d)")
+ROTATION_COMMAND = "dumpsys input | grep -E 'SurfaceOrientation|Viewport INTERNAL'"
+
+
+class TouchDevice:
+    """觸控螢幕的事件裝置與座標換算（width/height 為自然方向的 wm size）"""
+    def __init__(self, path, axes, has_btn_touch, width, height):
+        self.path = path
+        self.x_range = axes["ABS_MT_POSITION_X"]
+        self.y_range = axes["ABS_MT_POSITION_Y"]
+        self.slots = "ABS_MT_SLOT" in axes  # Type B 多點觸控協定
+        self.pressure = axes.get("ABS_MT_PRESSURE")
+        self.touch_major = axes.get("ABS_MT_TOUCH_MAJOR")
+        self.has_btn_touch = has_btn_touch
+        self.width = width
+        self.height = height
+
+    def raw(self, x, y, rotation=0):
+        """
+        螢幕座標 → 觸控裝置座標
+        觸控座標固定對應自然方向，畫面旋轉時（rotation: Surface.ROTATION_*）先換回自然方向
+        """
+        width, height = self.width, self.height
+        if rotation == 1:
+            x, y = width - 1 - y, x
+        elif rotation == 2:
+            x, y = width - 1 - x, height - 1 - y
+        elif rotation == 3:
+            x, y = y, height - 1 - x
+        (x_min, x_max), (y_min, y_max) = self.x_range, self.y_range
+        rx = x_min + int(x * (x_max - x_min + 1) / self.width)
+        ry = y_min + int(y * (y_max - y_min + 1) / self.height)
+        return min(max(rx, x_min), x_max), min(max(ry, y_min), y_max)
+
+
+def parse_touch_device(getevent_output, width, height):
+    """從 getevent -pl 輸出找出觸控螢幕，找不到返回 None"""
+    candidates = []
+    for block in getevent_output.split("add device")[1:]:
+        match = re.search(r"(/dev/input/event\d+)", block)
+        if not match:
+            continue
+        axes = {name: (int(lo), int(hi)) for name, lo, hi in _AXIS_RE.findall(block)}
+        if "ABS_MT_POSITION_X" not in axes or "ABS_MT_POSITION_Y" not in axes:
+            continue
+        device = TouchDevice(match.group(1), axes, "BTN_TOUCH" in block, width, height)
+        # 直接觸控的螢幕優先（排除觸控板等）
+        candidates.append((0 if "INPUT_PROP_DIRECT" in block else 1, len(candidates), device))
+    return min(candidates)[2] if candidates else None
+
+
+def parse_rotation(dumpsys_output):
+    """從 dumpsys input 輸出取得螢幕方向（0-3），找不到返回 None"""
+    match = _ROTATION_RE.search(dumpsys_output or "")
+    if not match:
+        return None
+    return int(match.group(1) or match.group(2)) % 4
+
+
+class InputChannel:
+    """
+    設備的輸入通道
+    手勢: ("tap", x, y) / ("swipe", x1, y1, x2, y2, 秒) / ("long_press", x, y, 秒) / ("sleep", 秒)
+    """
+    def __init__(self, device, mode="input"):
+        self.device = device
+        self.mode = mode
+        self.touch = None
+        self.rotation = None  # 目前螢幕方向（sendevent 模式），None 為無法取得
+        self._rotation_time = None
+        self._screen = None  # 最近一次回報的畫面尺寸 (h, w)
+        self._prepared = False
+        self._tracking_id = 0
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        """sendevent 模式：第一次使用時找出觸控裝置（只做一次）"""
+        with self._lock:
+            if self._prepared:
+                return
+            self._prepared = True
+            if self.mode != "sendevent":
+                return
+            width, height = core.adb_get_resolution(self.device)
+            _, output = core.adb_shell("getevent -pl", self.device)
+            touch = parse_touch_device(output or "", width, height) if width and height else None
+            if touch and (core.adb_shell(f"test -w {touch.path} && echo ok", self.device)[1] or "").strip() == "ok":
+                self.touch = touch
+                core.adb_log(f"InputChannel({self.device}): sendevent {touch.path} "
+                             f"x={touch.x_range} y={touch.y_range}")
+            else:
+                core.adb_log(f"InputChannel({self.device}): 找不到可寫入的觸控裝置，改用 input")
+
+    def observe(self, screen):
+        """
+        回報目前截圖尺寸 (h, w, ...)
+        尺寸改變（遊戲切換橫直向）時，下次點擊前才重新讀取螢幕方向；尺寸不變時不再讀取
+        """
+        screen = tuple(screen[:2])
+        with self._lock:
+            if screen != self._screen:
+                if self._screen is not None:
+                    self._rotation_time = None
+                self._screen = screen
+
+    def _refresh_rotation(self):
+        """
+        讀取目前螢幕方向（dumpsys input）
+        - 有回報畫面尺寸：只在第一次與尺寸改變後讀取
+        - 沒有回報：每 ROTATION_TTL 秒最多一次
+        讀不到方向但畫面尺寸與自然方向相同時視為未旋轉
+        """
+        now = time.monotonic()
+        if self._rotation_time is not None and (self._screen is not None or now - self._rotation_time < ROTATION_TTL):
+            return
+        self._rotation_time = now
+        rotation = parse_rotation(core.adb_shell(ROTATION_COMMAND, self.device)[1])
+        if rotation is None and self._screen == (self.touch.height, self.touch.width):
+            rotation = 0
+        if rotation != self.rotation:
+            if rotation is None:
+                core.adb_log(f"InputChannel({self.device}): 無法取得螢幕方向，改用 input")
+            else:
+                core.adb_log(f"InputChannel({self.device}): 螢幕方向 {rotation * 90}°")
+            self.rotation = rotation
+
+    # ============ 指令組合 ============
+
+    def _sendevent(self, events):
+        return [f"sendevent {self.touch.path} {t} {c} {v}" for t, c, v in events]
+
+    def _down(self, x, y):
+        touch = self.touch
+        rx, ry = touch.raw(x, y, self.rotation)
+        events = []
+        if touch.slots:
+            self._tracking_id = (self._tracking_id + 1) % 65536
+            events += [(EV_ABS, ABS_MT_SLOT, 0), (EV_ABS, ABS_MT_TRACKING_ID, self._tracking_id)]
+        if touch.has_btn_touch:
+            events.append((EV_KEY, BTN_TOUCH, 1))
+        events += [(EV_ABS, ABS_MT_POSITION_X, rx), (EV_ABS, ABS_MT_POSITION_Y, ry)]
+        if touch.pressure:
+            events.append((EV_ABS, ABS_MT_PRESSURE, max(1, touch.pressure[1] // 2)))
+        if touch.touch_major:
+            events.append((EV_ABS, ABS_MT_TOUCH_MAJOR, max(1, min(5, touch.touch_major[1]))))
+        if not touch.slots:
+            events.append((EV_SYN, SYN_MT_REPORT, 0))
+        events.append((EV_SYN, SYN_REPORT, 0))
+        return self._sendevent(events)
+
+    def _move(self, x, y):
+        rx, ry = self.touch.raw(x, y, self.rotation)
+        events = [(EV_ABS, ABS_MT_POSITION_X, rx), (EV_ABS, ABS_MT_POSITION_Y, ry)]
+        if not self.touch.slots:
+            events.append((EV_SYN, SYN_MT_REPORT, 0))
+        events.append((EV_SYN, SYN_REPORT, 0))
+        return self._sendevent(events)
+
+    def _up(self):
+        touch = self.touch
+        events = [(EV_ABS, ABS_MT_TRACKING_ID, -1)] if touch.slots else []
+        if touch.has_btn_touch:
+            events.append((EV_KEY, BTN_TOUCH, 0))
+        if not touch.slots:
+            events.append((EV_SYN, SYN_MT_REPORT, 0))
+        events.append((EV_SYN, SYN_REPORT, 0))
+        return self._sendevent(events)
+
+    def _gesture_events(self, gesture):
+        kind, args = gesture[0], gesture[1:]
+        if kind == "tap":
+            return self._down(*args) + self._up()
+        if kind == "long_press":
+            x, y, duration = args
+            return self._down(x, y) + [f"sleep {duration:.3f}"] + self._up()
+        if kind == "swipe":
+            x1, y1, x2, y2, duration = args
+            steps = max(2, min(MAX_SWIPE_STEPS, int(duration / SWIPE_STEP)))
+            lines = self._down(x1, y1)
+            for i in range(1, steps + 1):
+                lines.append(f"sleep {duration / steps:.3f}")
+                lines += self._move(round(x1 + (x2 - x1) * i / steps), round(y1 + (y2 - y1) * i / steps))
+            return lines + self._up()
+        if kind == "sleep":
+            return [f"sleep {args[0]:.3f}"]
+        raise ValueError(f"未知手勢: {kind}")
+
+    @staticmethod
+    def _gesture_input(gesture):
+        kind, args = gesture[0], gesture[1:]
+        if kind == "tap":
+            return [f"input tap {args[0]} {args[1]}"]
+        if kind == "long_press":
+            x, y, duration = args
+            return [f"input swipe {x} {y} {x} {y} {int(duration * 1000)}"]
+        if kind == "swipe":
+            x1, y1, x2, y2, duration = args
+            return [f"input swipe {x1} {y1} {x2} {y2} {int(duration * 1000)}"]
+        if kind == "sleep":
+            return [f"sleep {args[0]:.3f}"]
+        raise ValueError(f"未知手勢: {kind}")
+
+    def script(self, gestures):
+        """把手勢組成一段 shell 指令"""
+        self.prepare()
+        with self._lock:
+            if self.touch:
+                self._refresh_rotation()
+            # 方向不明時 sendevent 的座標換算不可靠，改用會依方向換算的 input
+            build = self._gesture_events if self.touch and self.rotation is not None else self._gesture_input
+            return "; ".join(line for gesture in gestures for line in build(gesture))
+
+    # ============ 執行 ============
+
+    def run(self, gestures):
+        """一次往返執行一串手勢，成功返回 True"""
+        returncode, _ = core.adb_shell(self.script(gestures), self.device)
+        return returncode == 0
+
+    def tap(self, x, y):
+        return self.run([("tap", x, y)])
+
+    def swipe(self, x1, y1, x2, y2, duration=0.3):
+        return self.run([("swipe", x1, y1, x2, y2, duration)])
+
+    def long_press(self, x, y, duration=0.8):
+        return self.run([("long_press", x, y, duration)])
+
+
+_channels = {}
+_channels_lock = threading.Lock()
+
+
+def get_channel(device, mode="input"):
+    """取得設備的輸入通道（同一設備與模式共用）"""
+    with _channels_lock:
+        channel = _channels.get((device, mode))
+        if channel is None:
+            channel = _channels[(device, mode)] = InputChannel(device, mode)
+        return channel
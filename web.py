@@ -4,7 +4,14 @@ Web 界面
 
 from flask import Flask, render_template, jsonify, request, Response
 from pathlib import Path
+import adb_client
 import core
+import capture
+import engine
+import history
+import matcher
+import touch
+import asyncio
 import threading
 import time
 import queue
@@ -12,6 +19,7 @@ import base64
 import cv2
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 BASE_DIR = Path(__file__).parent
 app = Flask(__name__, template_folder=str(BASE_DIR / "templates"))
@@ -19,12 +27,12 @@ app = Flask(__name__, template_folder=str(BASE_DIR / "templates"))
 # ============ 運行管理 ============
 
 class Runner:
-    """管理自動化運行"""
-    def __init__(self):
+    """管理單一設備的自動化運行"""
+    def __init__(self, device=None):
         self.thread = None
         self.status = "stopped"  # stopped, running
         self.profile_name = None
-        self.device = None
+        self.device = device
         self.logs = []
         self.max_logs = 100
         self.log_id_counter = 0  # 日誌 ID 計數器
@@ -34,6 +42,14 @@ class Runner:
         self.current_step_index = -1  # -1 表示尚未開始
         self.current_step_name = None
         self.step_names = []  # 啟用的步驟名稱列表
+        self.transitions = None  # 狀態轉移統計
+        self.match_budget = None  # 每幀比對時間預算（matcher.MatchBudget）
+        self.check_schedule = None  # 步驟檢查頻率（matcher.CheckSchedule）
+        # 單次運行的比對狀態
+        self.miss_count = 0
+        self.last_state = None  # 上一個匹配的狀態（轉移統計用）
+        self.last_tap_time = None
+        self.full_miss = False  # 上一次比對所有候選步驟都評分過且未匹配（畫面不變時可沿用結果）
 
     def log(self, msg):
         with self.lock:
@@ -73,10 +89,19 @@ class Runner:
         self.current_step_index = -1
         self.current_step_name = None
         self.step_names = []
+        self.miss_count = 0
+        self.last_state = None
+        self.last_tap_time = None
+        self.full_miss = False
+        self.check_schedule = matcher.CheckSchedule()
+
+        self._launch()
+        return True, "已啟動"
 
+    def _launch(self):
+        """啟動運行線程"""
         self.thread = threading.Thread(target=self._run_loop, daemon=True)
         self.thread.start()
-        return True, "已啟動"
 
     def stop(self):
         if self.status == "running":
@@ -99,18 +124,37 @@ class Runner:
                 return
 
         settings = core.get_shared_settings()
-        threshold = settings["match_threshold"]
-        loop_interval = settings["loop_interval"]
-        long_interval = settings["long_interval"]
-        miss_threshold = settings["miss_threshold"]
-        click_delay = settings["click_delay"]
 
-        miss_count = 0
+        # 畫面來源（單次截圖或持續串流）
+        source = capture.open_frame_source(self.device, settings, pipeline=settings["pipeline"])
+        # 狀態轉移統計（全部比對模式依此決定比對順序）
+        self.transitions = history.open_history(self.profile_name) if settings["learn_transitions"] else None
+        try:
+            self._loop(source, settings)
+        finally:
+            source.close()
+            if self.transitions:
+                history.close_history(self.transitions)
+
+        self.log("運行結束")
+
+    def _loop(self, source, settings):
+        """截圖 → 比對 → 點擊 循環"""
+        loop_interval = settings["loop_interval"]
         logged_screenshot_size = False
+        plan = None
+        scheduler = self._make_scheduler(settings)
+        self.match_budget = matcher.MatchBudget(settings["match_budget"]) if settings["match_budget"] > 0 else None
+
+        # 畫面未變化偵測
+        detector = core.FrameChangeDetector(settings["static_tolerance"]) if settings["skip_static_frames"] else None
+        static_miss_step = None  # 上次未匹配時的步驟位置（None 表示需要重新比對）
+        pending_frame = None  # 點擊後偵測到變化的畫面，下一輪直接比對
 
         while self.status != "stopped":
             # 截圖
-            screenshot = core.adb_screenshot(device=self.device)
+            screenshot = pending_frame if pending_frame is not None else source.grab()
+            pending_frame = None
             if screenshot is None:
                 self.log("截圖失敗")
                 time.sleep(loop_interval)
@@ -121,179 +165,349 @@ class Runner:
                 self.log(f"截圖尺寸: {screenshot.shape[1]}x{screenshot.shape[0]}")
                 logged_screenshot_size = True
 
-            # 載入狀態
-            states = core.get_states(self.profile_name)
-            all_state_names = list(states.keys())
-            total_steps = len(all_state_names)
-
-            # 建立啟用的步驟列表，保留原始索引
-            # (原始索引, 名稱, 設定)
-            enabled_states = [(i, name, cfg) for i, (name, cfg) in enumerate(states.items())
-                              if cfg.get("enabled", True)]
-            self.step_names = [name for _, name, _ in enabled_states]
+            plan, rebuilt = self._refresh_plan(plan, settings)
+            if rebuilt:
+                static_miss_step = None
+            for state_name, error in plan.frame_errors(screenshot):
+                self.log(f"[!] {state_name}: {error}")
 
-            if not enabled_states:
+            if not len(plan):
                 time.sleep(loop_interval)
                 continue
 
-            matched = False
-            matched_name = None
-            matched_index = -1
-
-            if self.sequential_mode:
-                # 順序模式
-                # 啟動時（index=-1）先全部比對，找到當前位置
-                if self.current_step_index == -1:
-                    candidates = list(enabled_states)  # 全部比對
-                else:
-                    candidates = self._get_sequential_candidates(enabled_states)
-
-                for enabled_idx, (orig_idx, state_name, config) in enumerate(candidates):
-                    match_result = self._try_match(screenshot, state_name, config, threshold)
-                    if match_result:
-                        min_score, click = match_result
-                        if click:
-                            if self.current_step_index == -1:
-                                self.log(f"初始定位: 從步驟 {orig_idx + 1} 開始")
-                            else:
-                                # 計算跳過的啟用步驟數
-                                skipped = enabled_idx
-                                if skipped > 0:
-                                    self.log(f"跳過 {skipped} 步")
-                            self.log(f"[{orig_idx + 1}/{total_steps}] 匹配: {state_name} ({min_score:.2f}) → 點擊 {click}")
-                            core.adb_tap(click[0], click[1], device=self.device)
-                            delay = click_delay[0] + (click_delay[1] - click_delay[0]) * (time.time() % 1)
-                            time.sleep(delay)
-
-                        matched = True
-                        matched_name = state_name
-                        matched_index = orig_idx
-
-                        # 更新當前步驟（使用在 enabled_states 中的位置）
-                        current_enabled_idx = next(i for i, (oi, n, c) in enumerate(enabled_states) if n == state_name)
-                        self.current_step_index = current_enabled_idx
-                        self.current_step_name = state_name
-
-                        # 如果是最後一個啟用的步驟，重新開始
-                        if current_enabled_idx >= len(enabled_states) - 1:
-                            self.log("完成一輪，重新開始")
-                            self.current_step_index = -1
-                            self.current_step_name = None
-
-                        miss_count = 0
-                        break
-
-                # 防呆：如果 candidates 都不匹配，且 candidates 全部都是可略過的，重新開始
-                if not matched and candidates:
-                    last_candidate_enabled_idx = next(
-                        (i for i, (oi, n, c) in enumerate(enabled_states) if n == candidates[-1][1]),
-                        -1
-                    )
-                    # 只有當 candidates 包含最後一個啟用步驟，且全部都是可略過的，才重新開始
-                    all_skippable = all(c.get("skippable", False) for _, _, c in candidates)
-                    if last_candidate_enabled_idx >= len(enabled_states) - 1 and all_skippable:
-                        self.log("尾端步驟皆未匹配，重新開始")
-                        self.current_step_index = -1
-                        self.current_step_name = None
+            step_before = self.current_step_index
+            frame_changed = detector.changed(screenshot, plan.watch_regions) if detector else True
+            if not frame_changed and static_miss_step == self.current_step_index:
+                # 畫面未變化且上次未匹配：結果相同，不重新比對
+                idx, click = None, None
             else:
-                # 全部比對模式：遍歷所有步驟
-                for orig_idx, state_name, config in enabled_states:
-                    match_result = self._try_match(screenshot, state_name, config, threshold)
-                    if match_result:
-                        min_score, click = match_result
-                        if click:
-                            self.log(f"匹配: {state_name} ({min_score:.2f}) → 點擊 {click}")
-                            core.adb_tap(click[0], click[1], device=self.device)
-                            delay = click_delay[0] + (click_delay[1] - click_delay[0]) * (time.time() % 1)
-                            time.sleep(delay)
-
-                        matched = True
-                        miss_count = 0
-                        break
-
-            if not matched:
-                miss_count += 1
-                if miss_count >= miss_threshold:
-                    time.sleep(long_interval)
-                else:
-                    time.sleep(loop_interval)
+                idx, click = self._decide(screenshot, plan)
+            matched = idx is not None
+
+            if matched:
+                if click:
+                    pending_frame = self._tap(source, click, settings, screenshot, plan.state_regions(idx))
+                self._record_match(plan.names[idx], scheduler)
+                static_miss_step = None
+            elif self.current_step_index == step_before and self.full_miss:
+                # 只有所有候選都評分過的未匹配才能沿用（未到檢查時間的步驟之後仍要比對）
+                static_miss_step = step_before
             else:
-                time.sleep(loop_interval)
+                static_miss_step = None
 
-        self.log("運行結束")
+            if pending_frame is not None:
+                # 點擊後畫面已變化，立即比對
+                continue
+            source.wait(self._next_wait(matched, scheduler, settings))
 
-    def _get_sequential_candidates(self, enabled_states):
-        """取得順序模式下要比對的步驟範圍
-        - 如果當前步驟是可重複的，從當前步驟開始
-        - 否則從 current_step_index + 1 開始
-        - 到下一個不可略過的步驟為止
-        enabled_states 格式: [(原始索引, 名稱, 設定), ...]
+    # ============ 比對流程（線程與 asyncio 運行共用） ============
+
+    def _make_scheduler(self, settings):
+        """自適應輪詢（長間隔為最長等待），未開啟返回 None"""
+        if not settings["adaptive_polling"]:
+            return None
+        return history.PollScheduler(self.transitions, settings["loop_interval"],
+                                     settings["long_interval"], settings["miss_threshold"])
+
+    def _refresh_plan(self, plan, settings):
+        """設定快照或模板變更時重新編譯比對計畫，返回 (plan, 是否重新編譯)"""
+        states = core.get_states_snapshot(self.profile_name)
+        if plan is not None and plan.is_current(states):
+            return plan, False
+        plan = matcher.build_plan(self.profile_name, states, settings)
+        self.step_names = list(plan.names)
+        for state_name, error in plan.errors.items():
+            self.log(f"[!] {state_name}: {error}")
+        return plan, True
+
+    def _decide(self, screenshot, plan):
         """
-        start_idx = self.current_step_index + 1
-        current_is_repeatable = False
-
-        # 如果當前步驟是可重複的，從當前步驟開始比對
-        if self.current_step_index >= 0 and self.current_step_index < len(enabled_states):
-            _, _, current_config = enabled_states[self.current_step_index]
-            if current_config.get("repeatable", False):
-                start_idx = self.current_step_index
-                current_is_repeatable = True
-
-        candidates = []
-
-        for idx in range(start_idx, len(enabled_states)):
-            orig_idx, state_name, config = enabled_states[idx]
-            candidates.append((orig_idx, state_name, config))
-
-            # 遇到不可略過的步驟就停止
-            # 但當前的 repeatable 步驟不算停止點（需要繼續往後找）
-            if not config.get("skippable", False):
-                if current_is_repeatable and idx == self.current_step_index:
-                    continue  # 跳過當前 repeatable 步驟
-                break
+        比對一幀並更新順序模式進度（不點擊）
+        返回 (匹配的步驟索引, 點擊座標（依搜尋範圍的偏移修正）)，未匹配返回 (None, None)
+        """
+        total_steps = len(plan.states)
+        self.full_miss = False
+
+        if not self.sequential_mode:
+            # 全部比對模式：依順序第一個匹配的步驟
+            # 有轉移統計時，最可能出現的狀態先單獨評分
+            order = self.transitions.order(self.last_state, plan) if self.transitions else plan.default_order
+            probe = 2 if self.transitions else 0
+            # 依檢查頻率略過這一幀不需比對的步驟
+            gated = self.check_schedule and ((plan.check_every != 1).any() or plan.check_by_time.any())
+            due = self.check_schedule.due(plan, order) if gated else order
+            hit, scored = self._first_match(plan, screenshot, due, probe)
+            if gated:
+                self.check_schedule.checked(plan, scored)
+            if not hit:
+                self.full_miss = len(scored) == len(order)
+                return None, None
+            _, idx, min_score = hit
+            click = plan.click_at(screenshot, idx)
+            if click:
+                self.log(f"匹配: {plan.names[idx]} ({min_score:.2f}) → 點擊 {list(click)}{self._offset_text(plan, idx, click)}")
+            return idx, click
+
+        # 順序模式
+        # 啟動時（index=-1）先全部比對，找到當前位置
+        if self.current_step_index == -1:
+            candidates = list(range(len(plan)))  # 全部比對
+        else:
+            candidates = plan.sequential_candidates(self.current_step_index)
+
+        hit, scored = self._first_match(plan, screenshot, candidates)
+        if not hit:
+            self.full_miss = len(scored) == len(candidates)
+            # 防呆：如果 candidates 都不匹配，且 candidates 全部都是可略過的，重新開始
+            # 只有當 candidates 包含最後一個啟用步驟，且全部都是可略過的，才重新開始
+            if (candidates and candidates[-1] >= len(plan) - 1
+                    and plan.skippable[candidates].all()):
+                self.log("尾端步驟皆未匹配，重新開始")
+                self.current_step_index = -1
+                self.current_step_name = None
+            return None, None
+
+        skipped, idx, min_score = hit
+        state_name = plan.names[idx]
+        click = plan.click_at(screenshot, idx)
+        orig_idx = int(plan.orig_index[idx])
+        if click:
+            if self.current_step_index == -1:
+                self.log(f"初始定位: 從步驟 {orig_idx + 1} 開始")
+            elif skipped > 0:
+                # 跳過的啟用步驟數
+                self.log(f"跳過 {skipped} 步")
+            self.log(f"[{orig_idx + 1}/{total_steps}] 匹配: {state_name} ({min_score:.2f}) → 點擊 {list(click)}{self._offset_text(plan, idx, click)}")
+
+        # 更新當前步驟（使用在啟用步驟中的位置）
+        self.current_step_index = idx
+        self.current_step_name = state_name
+
+        # 如果是最後一個啟用的步驟，重新開始
+        if idx >= len(plan) - 1:
+            self.log("完成一輪，重新開始")
+            self.current_step_index = -1
+            self.current_step_name = None
+        return idx, click
+
+    def _first_match(self, plan, screenshot, candidates, probe=0):
+        """依候選順序比對，返回 (匹配結果, 實際評分過的步驟索引)"""
+        if self.match_budget:
+            # 預算用完時只評分了部分候選，其餘延到下一幀
+            hit = self.match_budget.first_match(plan, screenshot, candidates)
+            return hit, self.match_budget.scored
+        hit = plan.first_match(screenshot, candidates, probe=probe)
+        return hit, candidates[:hit[0] + 1] if hit else list(candidates)
+
+    @staticmethod
+    def _offset_text(plan, idx, click):
+        """點擊座標與錄製位置不同時的日誌說明"""
+        recorded = plan.clicks[idx]
+        if tuple(click) == tuple(recorded):
+            return ""
+        return f"（偏移 {click[0] - recorded[0]:+d}, {click[1] - recorded[1]:+d}）"
+
+    def _record_match(self, state_name, scheduler):
+        """點擊後記錄轉移與間隔（從上次點擊到這次匹配）"""
+        if self.transitions:
+            elapsed = time.monotonic() - self.last_tap_time if self.last_tap_time else None
+            self.transitions.record(self.last_state, state_name, elapsed)
+        self.last_state = state_name
+        self.last_tap_time = time.monotonic()
+        self.miss_count = 0
+        if scheduler:
+            scheduler.matched(state_name)
+
+    def _next_wait(self, matched, scheduler, settings):
+        """下一次截圖前的等待秒數"""
+        if scheduler:
+            return scheduler.next_interval(matched)
+        if matched:
+            return settings["loop_interval"]
+        self.miss_count += 1
+        if self.miss_count >= settings["miss_threshold"]:
+            return settings["long_interval"]
+        return settings["loop_interval"]
+
+    def _tap(self, source, click, settings, frame, regions):
+        """
+        點擊並等待擬人延遲（管線模式下交給背景執行器）
+        wait_for_change 開啟時改為等到畫面變化（至少 change_min_delay），返回變化後的畫面
+        """
+        if settings["wait_for_change"]:
+            min_delay = settings["change_min_delay"]
+            delay = min_delay[0] + (min_delay[1] - min_delay[0]) * (time.time() % 1)
+            tapped_at = time.monotonic()
+            if source.executor:
+                source.executor.submit(core.adb_tap, click[0], click[1], device=self.device, mode=settings["input_mode"], screen=frame.shape)
+            else:
+                core.adb_tap(click[0], click[1], device=self.device, mode=settings["input_mode"], screen=frame.shape)
+            return capture.wait_for_change(
+                source, frame, capture.tap_watch_regions(frame, click, regions), tapped_at,
+                delay, settings["change_timeout"], settings["change_tolerance"],
+                stop=lambda: self.status == "stopped"
+            )
 
-        return candidates
+        click_delay = settings["click_delay"]
+        delay = click_delay[0] + (click_delay[1] - click_delay[0]) * (time.time() % 1)
+        if source.executor:
+            source.executor.submit(core.adb_tap, click[0], click[1], device=self.device, mode=settings["input_mode"], screen=frame.shape, delay=delay)
+        else:
+            core.adb_tap(click[0], click[1], device=self.device, mode=settings["input_mode"], screen=frame.shape)
+            time.sleep(delay)
+        return None
+
+
+class AsyncRunner(Runner):
+    """
+    asyncio 運行：在共用引擎的事件迴圈中執行，不佔用專屬線程
+    截圖與點擊走非同步 ADB，解碼與比對交給引擎的線程池
+    串流、管線化與點擊後等待變化只在線程運行中支援，此模式下忽略
+    """
+    def _launch(self):
+        """在引擎事件迴圈排入運行協程"""
+        self.thread = None
+        self.future = engine.engine.submit(self._arun())
 
-    def _try_match(self, screenshot, state_name, config, threshold):
-        """嘗試匹配單一步驟，返回 (min_score, click) 或 None"""
-        template_path = core.get_template_path(state_name, self.profile_name)
+    async def _arun(self):
+        mode_text = "順序模式" if self.sequential_mode else "全部比對"
+        self.log(f"開始運行: {self.profile_name} ({self.device}) [{mode_text}, asyncio]")
+        eng = engine.engine
+        try:
+            # 嘗試連接（如果是 localhost:port 格式）
+            if self.device.startswith("localhost:") and not await eng.adb.connect(self.device):
+                self.log(f"無法連接 ADB: {self.device}")
+                return
 
-        # 直接嘗試讀取，不用 exists() 檢查（Windows 中文路徑相容性）
-        template = core.imread_safe(template_path)
-        if template is None:
-            self.log(f"[!] {state_name}: 無法讀取模板")
-            return None
+            settings = core.get_shared_settings()
+            self.transitions = history.open_history(self.profile_name) if settings["learn_transitions"] else None
+            try:
+                await self._aloop(settings)
+            finally:
+                if self.transitions:
+                    await eng.compute(history.close_history, self.transitions)
+            self.log("運行結束")
+        except Exception as e:
+            self.log(f"運行錯誤: {e}")
+        finally:
+            self.status = "stopped"
 
-        # 檢查尺寸是否一致
-        if screenshot.shape[:2] != template.shape[:2]:
-            self.log(f"[!] {state_name}: 尺寸不符 截圖={screenshot.shape[1]}x{screenshot.shape[0]} 模板={template.shape[1]}x{template.shape[0]}")
+    async def _aloop(self, settings):
+        """截圖 → 比對 → 點擊 循環（asyncio 版）"""
+        eng = engine.engine
+        loop_interval = settings["loop_interval"]
+        click_delay = settings["click_delay"]
+        logged_screenshot_size = False
+        plan = None
+        scheduler = self._make_scheduler(settings)
+        self.match_budget = matcher.MatchBudget(settings["match_budget"]) if settings["match_budget"] > 0 else None
+        channel = touch.get_channel(self.device, settings["input_mode"])
+        await eng.compute(channel.prepare)  # 找觸控裝置需要同步 ADB 呼叫
+
+        # 畫面未變化偵測
+        detector = core.FrameChangeDetector(settings["static_tolerance"]) if settings["skip_static_frames"] else None
+        static_miss_step = None
+
+        def analyze(screenshot, plan, static_miss_step):
+            """線程池中執行：畫面變化偵測與比對"""
+            frame_changed = detector.changed(screenshot, plan.watch_regions) if detector else True
+            if not frame_changed and static_miss_step == self.current_step_index:
+                return None, None
+            return self._decide(screenshot, plan)
 
-        regions = core.get_regions(config)
-        if not regions:
-            self.log(f"[!] {state_name}: 沒有設定區域")
-            return None
+        while self.status != "stopped":
+            screenshot = await eng.screenshot(self.device, settings["capture_mode"])
+            if screenshot is None:
+                self.log("截圖失敗")
+                await asyncio.sleep(loop_interval)
+                continue
 
-        # 比對所有區域（全部通過才算匹配）
-        min_score = 1.0
-        for region in regions:
-            frame_region = core.crop_region(screenshot, region)
-            template_region = core.crop_region(template, region)
+            if not logged_screenshot_size:
+                self.log(f"截圖尺寸: {screenshot.shape[1]}x{screenshot.shape[0]}")
+                logged_screenshot_size = True
+
+            plan, rebuilt = await eng.compute(self._refresh_plan, plan, settings)
+            if rebuilt:
+                static_miss_step = None
+            for state_name, error in plan.frame_errors(screenshot):
+                self.log(f"[!] {state_name}: {error}")
 
-            if frame_region is None or template_region is None:
-                self.log(f"[!] {state_name}: 區域 {region} 超出範圍")
-                return None
+            if not len(plan):
+                await asyncio.sleep(loop_interval)
+                continue
+
+            step_before = self.current_step_index
+            idx, click = await eng.compute(analyze, screenshot, plan, static_miss_step)
+            matched = idx is not None
+
+            if matched:
+                if click:
+                    channel.observe(screenshot.shape)
+                    await eng.adb.tap(self.device, click[0], click[1], channel)
+                    await asyncio.sleep(click_delay[0] + (click_delay[1] - click_delay[0]) * (time.time() % 1))
+                self._record_match(plan.names[idx], scheduler)
+                static_miss_step = None
+            elif self.current_step_index == step_before and self.full_miss:
+                # 只有所有候選都評分過的未匹配才能沿用（未到檢查時間的步驟之後仍要比對）
+                static_miss_step = step_before
+            else:
+                static_miss_step = None
 
-            score = core.match_region(frame_region, template_region)
-            min_score = min(min_score, score)
-            if score < threshold:
-                return None
+            await asyncio.sleep(self._next_wait(matched, scheduler, settings))
 
-        click = config.get("click", [])
-        return (min_score, click)
 
+class RunnerManager:
+    """
+    多設備運行管理：每個設備一個 Runner，全部在同一個行程內
+    模板/設定快取與 ADB 連線池都是模組層級的共用實例，不會因設備數量而重複
+    """
+    DEFAULT_DEVICE = "localhost:5555"
 
-# 全局 runner 實例
-runner = Runner()
+    def __init__(self):
+        self._runners = {}
+        self._lock = threading.Lock()
+
+    def get(self, device=None):
+        """
+        取得設備的 Runner（唯讀查詢，不建立）
+        沒運行過的設備返回不保存的停止狀態 Runner，客戶端送來的任意設備名稱不會累積
+        """
+        device = device or self.DEFAULT_DEVICE
+        with self._lock:
+            runner = self._runners.get(device)
+        return runner if runner is not None else Runner(device)
+
+    def start(self, profile_name, device=None):
+        """啟動設備的運行（依 engine 設定使用線程或 asyncio 運行，只有這裡會建立 Runner）"""
+        device = device or self.DEFAULT_DEVICE
+        runner_class = AsyncRunner if core.get_shared_settings().get("engine") == "asyncio" else Runner
+        with self._lock:
+            runner = self._runners.get(device)
+            if runner is None or (runner.status != "running" and type(runner) is not runner_class):
+                runner = self._runners[device] = runner_class(device)
+        return runner.start(profile_name, device=device)
+
+    def stop(self, device=None):
+        return self.get(device).stop()
+
+    def stop_all(self):
+        with self._lock:
+            runners = list(self._runners.values())
+        for runner in runners:
+            runner.stop()
+
+    def statuses(self):
+        """所有設備的運行狀態"""
+        with self._lock:
+            runners = list(self._runners.values())
+        return [
+            {"device": r.device, "status": r.status, "profile": r.profile_name}
+            for r in runners
+        ]
+
+
+# 全局運行管理
+runners = RunnerManager()
 
 
 # ============ 頁面路由 ============
@@ -313,7 +527,7 @@ def profile_page(name):
         return "Profile 不存在", 404
     states = core.get_states(name)
     sequential_mode = config.get("sequential_mode", False)
-    return render_template("profile.html", name=name, states=states, runner=runner,
+    return render_template("profile.html", name=name, states=states,
                           sequential_mode=sequential_mode)
 
 
@@ -352,7 +566,10 @@ def api_get_settings():
 def api_save_settings():
     """儲存設定"""
     data = request.json
-    core.save_json(core.SHARED_DIR / "settings.json", data)
+    # 合併既有設定，保留頁面上沒有的進階欄位
+    settings = core.get_shared_settings()
+    settings.update(data)
+    core.save_json(core.SHARED_DIR / "settings.json", settings)
     return jsonify({"success": True})
 
 
@@ -436,6 +653,19 @@ def api_save_state(name):
     if not regions:
         return jsonify({"error": "請選擇至少一個區域"}), 400
 
+    # 檢查頻率（未提供時保留原設定）
+    check_every = data.get("check_every")
+    check_unit = data.get("check_unit", "frames")
+    if check_every is not None:
+        try:
+            core.set_check_frequency({}, check_every, check_unit)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"檢查頻率無效: {e}"}), 400
+    # 搜尋範圍（null 為使用共用設定，未提供時保留原設定）
+    search_margin = data.get("search_margin")
+    if search_margin is not None and (not isinstance(search_margin, int) or search_margin < 0):
+        return jsonify({"error": "搜尋範圍必須是 0 以上的整數"}), 400
+
     # 處理模板
     screenshot_b64 = data.get("screenshot")
     template_path = core.get_template_path(state_name, name)
@@ -482,6 +712,9 @@ def api_save_state(name):
         new_state_config["enabled"] = old_config.get("enabled", True)
         new_state_config["skippable"] = old_config.get("skippable", False)
         new_state_config["repeatable"] = old_config.get("repeatable", False)
+        for key in ("priority", "check_every", "check_unit", "search_margin"):
+            if key in old_config:
+                new_state_config[key] = old_config[key]
 
         # 重建 states 保持順序
         new_states = {}
@@ -502,8 +735,18 @@ def api_save_state(name):
         new_state_config["enabled"] = old_config.get("enabled", True)
         new_state_config["skippable"] = old_config.get("skippable", False)
         new_state_config["repeatable"] = old_config.get("repeatable", False)
+        for key in ("priority", "check_every", "check_unit", "search_margin"):
+            if key in old_config:
+                new_state_config[key] = old_config[key]
         config["states"][state_name] = new_state_config
 
+    if check_every is not None:
+        core.set_check_frequency(new_state_config, check_every, check_unit)
+    if "search_margin" in data:
+        if search_margin is None:
+            new_state_config.pop("search_margin", None)
+        else:
+            new_state_config["search_margin"] = search_margin
     core.save_profile_config(name, config)
 
     return jsonify({"success": True})
@@ -625,6 +868,54 @@ def api_toggle_repeatable(name, state_name):
     return jsonify({"success": True, "repeatable": repeatable})
 
 
+@app.route("/api/profile/<name>/state/<state_name>/priority", methods=["POST"])
+def api_set_priority(name, state_name):
+    """設定步驟優先度（多個步驟同時匹配時，優先度高者優先）"""
+    data = request.json
+    try:
+        priority = int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "優先度必須是整數"}), 400
+
+    config = core.get_profile_config(name)
+    if config is None:
+        return jsonify({"error": "Profile 不存在"}), 404
+
+    states = config.get("states", {})
+    if state_name not in states:
+        return jsonify({"error": "狀態不存在"}), 404
+
+    if priority:
+        states[state_name]["priority"] = priority
+    else:
+        states[state_name].pop("priority", None)
+    core.save_profile_config(name, config)
+
+    return jsonify({"success": True, "priority": priority})
+
+
+@app.route("/api/profile/<name>/state/<state_name>/frequency", methods=["POST"])
+def api_set_check_frequency(name, state_name):
+    """設定步驟檢查頻率（every 幀或秒比對一次，1 幀為每幀）"""
+    data = request.json or {}
+    config = core.get_profile_config(name)
+    if config is None:
+        return jsonify({"error": "Profile 不存在"}), 404
+
+    states = config.get("states", {})
+    if state_name not in states:
+        return jsonify({"error": "狀態不存在"}), 404
+
+    try:
+        core.set_check_frequency(states[state_name], data.get("every", 1), data.get("unit", "frames"))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"檢查頻率無效: {e}"}), 400
+    core.save_profile_config(name, config)
+
+    every, unit = core.get_check_frequency(states[state_name])
+    return jsonify({"success": True, "every": every, "unit": unit})
+
+
 # ============ 截圖 API ============
 
 @app.route("/api/profile/<name>/state/<state_name>/screenshot")
@@ -668,47 +959,172 @@ def api_screenshot():
 
 # ============ 設備 API ============
 
-def scan_adb_ports():
-    """掃描常見 ADB 端口，找出正在監聽的"""
+ADB_SCAN_PORTS = list(range(5554, 5600)) + [62001, 62025]
+
+
+def scan_adb_ports(timeout=0.1):
+    """同時探測常見 ADB 端口（非阻塞連線），找出正在監聽的"""
+    import select
     import socket
+    pending = {}
     listening = []
     # 雷電: 5554, 5556, 5558...  BlueStacks: 5555, 5565, 5575...  夜神: 62001...
-    for port in list(range(5554, 5600)) + [62001, 62025]:
+    for port in ADB_SCAN_PORTS:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(0.1)
-        result = sock.connect_ex(('127.0.0.1', port))
-        sock.close()
-        if result == 0:
-            listening.append(port)
-    return listening
+        sock.setblocking(False)
+        sock.connect_ex(('127.0.0.1', port))
+        pending[sock] = port
+
+    deadline = time.monotonic() + timeout
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            socks = list(pending)
+            _, writable, failed = select.select([], socks, socks, remaining)
+            if not writable and not failed:
+                break
+            for sock in set(writable) | set(failed):
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0 and sock not in failed:
+                    listening.append(pending[sock])
+                del pending[sock]
+                sock.close()
+    finally:
+        for sock in pending:
+            sock.close()
+    return sorted(listening)
+
+
+class DeviceMonitor:
+    """
+    設備探索
+    - 背景線程訂閱 adb server 的 host:track-devices，設備增減即時更新列表
+    - 端口掃描結果快取 SCAN_INTERVAL 秒，過期時在背景重新掃描，只連接新出現的端口
+    - 無法訂閱時（adb server 未啟動、使用 adb 指令）改用 adb_list_devices，結果快取 LIST_TTL 秒
+    """
+    SCAN_INTERVAL = 30.0
+    LIST_TTL = 3.0
+    RETRY_DELAY = 5.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tracked = None  # track-devices 的最新序號列表，None 表示未訂閱
+        self._listed = None  # (時間, 設備列表)
+        self._scanned_at = None
+        self._scanning = False
+        self._tracker = None
+
+    def start(self):
+        """啟動 track-devices 訂閱線程（重複呼叫無作用）"""
+        with self._lock:
+            if self._tracker is not None or not core.USE_NATIVE_ADB:
+                return
+            self._tracker = threading.Thread(target=self._track, daemon=True)
+            self._tracker.start()
+
+    def _track(self):
+        while True:
+            try:
+                for entries in adb_client.client.track_devices():
+                    serials = [serial for serial, status in entries if status == "device"]
+                    with self._lock:
+                        self._tracked = serials
+            except (adb_client.AdbError, OSError, ValueError) as e:
+                core.adb_log(f"DeviceMonitor: track-devices 中斷 - {e}")
+            with self._lock:
+                self._tracked = None
+            time.sleep(self.RETRY_DELAY)
+
+    def _known_ids(self):
+        with self._lock:
+            if self._tracked is not None:
+                return {d["id"] for d in core.format_devices(self._tracked)}
+            if self._listed is not None:
+                return {d["id"] for d in self._listed[1]}
+        return set()
+
+    def _scan(self):
+        """掃描端口並並行連接尚未出現的設備，返回是否有新連接"""
+        connected = False
+        try:
+            known = self._known_ids()
+            ports = [port for port in scan_adb_ports() if f"localhost:{port}" not in known]
+            if ports:
+                with ThreadPoolExecutor(max_workers=min(8, len(ports))) as pool:
+                    connected = any(list(pool.map(lambda port: core.adb_connect(port=port), ports)))
+        finally:
+            with self._lock:
+                self._scanned_at = time.monotonic()
+                self._scanning = False
+                if connected:
+                    self._listed = None
+        return connected
+
+    def devices(self, rescan=False):
+        """目前的設備列表；rescan 時立即重新掃描端口"""
+        self.start()
+        with self._lock:
+            stale = self._scanned_at is None or time.monotonic() - self._scanned_at > self.SCAN_INTERVAL
+            background = stale and not rescan and self._scanned_at is not None and not self._scanning
+            if background:
+                self._scanning = True
+
+        connected = False
+        if rescan or (stale and self._scanned_at is None):
+            connected = self._scan()
+        elif background:
+            threading.Thread(target=self._scan, daemon=True).start()
+
+        with self._lock:
+            tracked = self._tracked
+            listed = self._listed
+        # 剛連接的設備可能還沒出現在 track-devices，直接查詢一次
+        if tracked is not None and not connected:
+            return core.format_devices(tracked)
+        if listed is not None and not connected and time.monotonic() - listed[0] < self.LIST_TTL:
+            return listed[1]
+        devices = core.adb_list_devices()
+        with self._lock:
+            self._listed = (time.monotonic(), devices)
+        return devices
+
+
+# 全局設備探索
+device_monitor = DeviceMonitor()
 
 
 @app.route("/api/devices")
 def api_list_devices():
-    """列出所有已連接的 ADB 設備"""
-    # 掃描並連接監聽中的 ADB 端口
-    for port in scan_adb_ports():
-        core.adb_connect(port=port)
-
-    devices = core.adb_list_devices()
-    return jsonify({"devices": devices})
+    """列出所有已連接的 ADB 設備（rescan=1 時重新掃描端口）"""
+    rescan = request.args.get("rescan", "0") == "1"
+    return jsonify({"devices": device_monitor.devices(rescan=rescan)})
 
 
 # ============ 運行控制 API ============
+# 各 API 以 device 參數指定設備（JSON 或查詢參數），未指定時為 localhost:5555
+
+@app.route("/api/runners")
+def api_runners():
+    """所有設備的運行狀態"""
+    return jsonify({"runners": runners.statuses()})
+
 
 @app.route("/api/runner/start/<profile_name>", methods=["POST"])
 def api_runner_start(profile_name):
     """啟動運行"""
     data = request.json or {}
     device = data.get("device")
-    success, msg = runner.start(profile_name, device=device)
+    success, msg = runners.start(profile_name, device=device)
     return jsonify({"success": success, "message": msg})
 
 
 @app.route("/api/runner/stop", methods=["POST"])
 def api_runner_stop():
     """停止"""
-    success = runner.stop()
+    data = request.get_json(silent=True) or {}
+    device = data.get("device") or request.args.get("device")
+    success = runners.stop(device)
     return jsonify({"success": success})
 
 
@@ -716,10 +1132,12 @@ def api_runner_stop():
 def api_runner_status():
     """取得運行狀態"""
     since = request.args.get("since", 0, type=int)
+    runner = runners.get(request.args.get("device"))
     return jsonify({
+        "device": runner.device,
         "status": runner.status,
         "profile": runner.profile_name,
-        "logs": runner.get_logs(since),
+        "logs": runner.get_logs_since(since),
         "log_count": len(runner.logs),
         "sequential_mode": runner.sequential_mode,
         "current_step_index": runner.current_step_index,
@@ -735,6 +1153,7 @@ def api_runner_stream():
 
     # 從查詢參數取得客戶端已有的最後日誌 ID（用於重連）
     last_log_id = request.args.get('since', 0, type=int)
+    device = request.args.get("device")
 
     def generate():
         nonlocal last_log_id
@@ -742,6 +1161,7 @@ def api_runner_stream():
         last_step_index = None
 
         while True:
+            runner = runners.get(device)  # 切換運行方式時 Runner 會被替換
             status = runner.status
             current_log_id = runner.get_latest_log_id()
             step_index = runner.current_step_index
@@ -755,6 +1175,7 @@ def api_runner_stream():
                 new_logs = runner.get_logs_since(last_log_id)
                 data = {
                     "status": status,
+                    "profile": runner.profile_name,
                     "logs": new_logs,
                     "last_log_id": current_log_id,
                     "sequential_mode": runner.sequential_mode,
@@ -789,9 +1210,8 @@ def find_free_port(start_port=8080, max_attempts=10):
 
 
 def on_closing():
-    """視窗關閉時停止運行中的任務"""
-    if runner.status == "running":
-        runner.stop()
+    """視窗關閉時停止所有運行中的任務"""
+    runners.stop_all()
 
 
 def wait_for_server(url, timeout=10):
@@ -858,6 +1278,9 @@ if __name__ == "__main__":
         flask_thread.start()
         log("Flask 線程已啟動")
 
+        # 背景預先掃描設備，開啟頁面時直接使用結果
+        threading.Thread(target=device_monitor.devices, daemon=True).start()
+
         # 等待 Flask 就緒
         log("等待伺服器就緒...")
         if not wait_for_server(url):